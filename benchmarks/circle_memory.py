@@ -0,0 +1,55 @@
+"""
+Measures the peak resident memory of rendering the example magic circle (`circle.main()`) with the rotate backend
+under several values of `render.memory_budget`, and with the polar backend. Every variant runs in a fresh process,
+since peak RSS can not be reset.
+
+The budget covers the buffers a ring is drawn in. The finished circle and the glyph sprite and layer caches come on
+top of it, so their sizes are listed as well.
+Run from the repository root: python -m benchmarks.circle_memory
+"""
+import resource
+import subprocess
+import sys
+import time
+
+MiB = 1024 * 1024
+VARIANTS = {'unlimited budget': 1 << 40, '256 MiB budget (default)': 256 * MiB, '32 MiB budget': 32 * MiB,
+            '8 MiB budget': 8 * MiB, 'polar': 256 * MiB}
+
+
+def run_variant(name):
+    from runicbabble.config import cfg
+    from runicbabble.formats import circle
+
+    cfg.render.memory_budget = VARIANTS[name]
+    mc = circle.example_circle()
+    if name == 'polar':
+        for seg in mc.segments:
+            if isinstance(seg, circle.TextRing):
+                seg.backend = 'polar'
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    img = mc.render()
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    kept = img.width * img.height * 4 + circle.sprites.stats()['weight'] + circle.layers.stats()['weight']
+    # ru_maxrss is in KiB on Linux
+    print(f'{before} {peak} {kept // 1024} {elapsed}')
+
+
+def main():
+    print(f'{"":26} {"peak RSS":>10} {"render delta":>13} {"kept":>9} {"time":>8}')
+    for name in VARIANTS:
+        out = subprocess.run([sys.executable, '-m', 'benchmarks.circle_memory', name],
+                             capture_output=True, text=True, check=True).stdout.split()
+        before, peak, kept, elapsed = int(out[-4]), int(out[-3]), int(out[-2]), float(out[-1])
+        print(f'{name:26} {peak / 1024:8.1f}MB {(peak - before) / 1024:11.1f}MB {kept / 1024:7.1f}MB '
+              f'{elapsed:7.2f}s')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        run_variant(sys.argv[1])
+    else:
+        main()
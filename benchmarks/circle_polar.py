@@ -0,0 +1,44 @@
+"""
+Compares the 'rotate' and 'polar' TextRing backends on single rings of various sizes.
+Run from the repository root: python -m benchmarks.circle_polar
+"""
+import time
+
+from runicbabble import fonts
+from runicbabble.formats import circle
+
+TEXT = 'Vetz pryti nyfti ay úud sey. '
+
+
+def ring_circle(inner_radius, font_size, backend):
+    font = fonts.load(fonts.MADOUJI_PATH, font_size)
+    ring = circle.TextRing(TEXT * max(inner_radius // (font_size * 4), 1), font, (100, 200, 255), backend=backend)
+    mc = circle.MagicCircle([circle.CenterNgon(inner_radius, 5), ring])
+    mc.radius = sum(seg.radius + seg.margin for seg in mc.segments)
+    mc.center = (mc.radius, mc.radius)
+    return mc, ring
+
+
+def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(repeat=3):
+    print(f'{"radius":>7} {"font":>5} {"rotate":>10} {"polar":>10} {"speedup":>8}')
+    for inner_radius, font_size in [(100, 30), (250, 30), (250, 60), (500, 60), (500, 120), (1000, 120)]:
+        times = {}
+        for backend in ('rotate', 'polar'):
+            mc, ring = ring_circle(inner_radius, font_size, backend)
+            times[backend] = timed(lambda: ring.render_layer(mc, inner_radius), repeat)
+        print(f'{inner_radius:7} {font_size:5} {times["rotate"] * 1000:8.1f}ms {times["polar"] * 1000:8.1f}ms '
+              f'{times["rotate"] / times["polar"]:7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
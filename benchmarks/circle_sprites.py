@@ -0,0 +1,52 @@
+"""
+Compares rendering the example magic circle (`circle.main()`) with and without the rotated glyph sprite cache. The
+segment layer cache is cleared before every render, so every ring is drawn again.
+Run from the repository root: python -m benchmarks.circle_sprites
+"""
+import time
+
+from runicbabble.formats import circle
+
+
+def timed(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times), sum(times) / len(times)
+
+
+def main(repeat=5):
+    mc = circle.example_circle()
+    cached = circle.rotated_glyph
+
+    def uncached(char, fill=None, font=None, angle=0.0):
+        return circle.angled_text(char, fill=fill, font=font, angle=angle)
+
+    def render():
+        circle.layers.clear()
+        mc.render()
+
+    def cold():
+        circle.sprites.clear()
+        render()
+
+    circle.rotated_glyph = uncached
+    try:
+        results = {'no cache': timed(render, repeat)}
+    finally:
+        circle.rotated_glyph = cached
+    results['cold cache'] = timed(cold, repeat)
+    render()
+    results['warm cache'] = timed(render, repeat)
+
+    baseline = results['no cache'][0]
+    print(f'{"":12} {"best":>9} {"mean":>9} {"speedup":>8}')
+    for name, (best, mean) in results.items():
+        print(f'{name:12} {best * 1000:7.1f}ms {mean * 1000:7.1f}ms {baseline / best:7.2f}x')
+    print(f'sprites cached: {circle.sprites.stats()}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Compares drawing the example magic circle, scaled up, as a PNG with the 'rotate' and 'vector' TextRing backends and
+as an SVG document built from the glyph outlines. The layer and sprite caches are cleared before every render.
+Run from the repository root: python -m benchmarks.circle_vector
+"""
+import io
+import time
+
+from runicbabble import fonts
+from runicbabble.formats import circle
+
+COLOR = (100, 200, 255)
+
+
+def scaled_circle(scale, backend):
+    font = fonts.load(fonts.MADOUJI_PATH, 60)
+
+    def ring(text, size):
+        return circle.TextRing(text, fonts.variant(font, size * scale), COLOR, backend=backend)
+
+    def separator(style):
+        return circle.RingSeparator(style, COLOR)
+
+    return circle.MagicCircle([
+        circle.CenterNgon(380 * scale, 8, rotation=-1.5708, outline=COLOR, width=6 * scale),
+        separator('m'),
+        ring('#hey dok', 120),
+        separator('ss'),
+        ring('ayv ymprUvd may progrem, so naó yt dZenereýtz VIz swrklz Iseli. ', 30),
+        separator('m'),
+        ring('Vetz pryti nyfti ay úud sey. ', 60),
+        separator('sl'),
+    ])
+
+
+def png(mc):
+    with io.BytesIO() as image_binary:
+        mc.render().save(image_binary, 'PNG')
+        return image_binary.getvalue()
+
+
+def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        circle.layers.clear()
+        circle.sprites.clear()
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def main(repeat=3):
+    # the first run also parses the glyph outlines, which are cached from then on
+    circle.MagicCircle.svg(scaled_circle(1, 'vector'))
+
+    print(f'{"scale":>5} {"size":>11} {"rotate png":>19} {"vector png":>19} {"svg":>19}')
+    for scale in (1, 2, 4):
+        row = ''
+        for backend, render in (('rotate', png), ('vector', png), ('vector', lambda mc: mc.svg().encode())):
+            if backend == 'rotate' and scale > 2:
+                row += f' {"(too slow)":>19}'
+                continue
+            mc = scaled_circle(scale, backend)
+            data, elapsed = timed(lambda: render(mc), 1 if backend == 'rotate' else repeat)
+            row += f' {elapsed * 1000:8.1f}ms {len(data) / 1024:7.0f}KB'
+        print(f'{scale:5} {f"{2 * mc.radius}x{2 * mc.radius}":>11}{row}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Measures the peak resident memory of rendering long messages, either as one image (the old behaviour) or as tiles
+of bounded height (`mdj_image.render_tiles`). Every variant runs in a fresh process, since peak RSS can not be reset.
+Run from the repository root: python -m benchmarks.long_messages
+"""
+import resource
+import subprocess
+import sys
+import time
+
+SENTENCE = "Vetz pryti nyfti ay u'ud sey. so nao yt dZenereytz VIz swrklz Iseli. "
+LENGTHS = [20, 200, 1000]
+
+
+def run_variant(name, repeats):
+    import runicbabble.discord  # noqa: F401, resolves the import cycle with mdj_emotes
+    from runicbabble.formats import encode, mdj_image
+
+    mdj_image.warmup()
+    key = mdj_image.render_key(SENTENCE * repeats, 32, 'flow', 24)
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    if name == 'one image':
+        images = [encode.encode(mdj_image._render_mask(*key))]
+    else:
+        images = list(mdj_image.render_tiles(*key))
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux
+    print(f'{before} {peak} {elapsed} {len(images)} {max(map(len, images))}')
+
+
+def main():
+    print(f'{"":24} {"render delta":>13} {"time":>8} {"images":>7} {"largest file":>13}')
+    for repeats in LENGTHS:
+        for name in ('one image', 'tiles'):
+            out = subprocess.run([sys.executable, '-m', 'benchmarks.long_messages', name, str(repeats)],
+                                 capture_output=True, text=True, check=True).stdout.split()
+            before, peak, elapsed, count, largest = int(out[-5]), int(out[-4]), float(out[-3]), int(out[-2]), \
+                int(out[-1])
+            label = f'{len(SENTENCE) * repeats} chars, {name}'
+            print(f'{label:24} {(peak - before) / 1024:11.1f}MB {elapsed:7.2f}s {count:7} {largest / 1024:11.0f}KB')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        run_variant(sys.argv[1], int(sys.argv[2]))
+    else:
+        main()
@@ -0,0 +1,73 @@
+"""
+Measures how many messages per second `on_message` can classify, comparing the previous implementation (regex
+search on every message, then asking every language) with the prefilter and dispatch table.
+Run from the repository root: python -m benchmarks.message_dispatch
+"""
+import random
+import re
+import time
+
+import runicbabble.discord  # noqa: F401, resolves the import cycle with mdj_emotes
+import runicbabble.lang
+from runicbabble.formats import mdj_emotes
+from runicbabble.lang.madouji import Madouji
+
+CHAT = [
+    'lol', 'good morning everyone!', 'did anyone see the new episode yet?', 'https://example.com/some/link',
+    'I think the `config` value is wrong, try `sync_slash: true`', '<@123456789012345678> check this out',
+    '```py\nprint("hello")\n```', 'that is so cool :D', 'brb', 'the wiki says `mdj` is the tag to use',
+    'ok so basically ' * 20,
+]
+MADOUJI = ["hey `mdj ayv ymprUvd may progrem` :)", "`mdj Vetz pryti nyfti ay u'ud sey.`",
+           "```mdj-8 so nao' yt dZenereýtz VIz swrklz Iseli```"]
+
+
+def corpus(size=20000, madouji_share=0.02, seed=1):
+    rng = random.Random(seed)
+    return [rng.choice(MADOUJI) if rng.random() < madouji_share else rng.choice(CHAT) for _ in range(size)]
+
+
+def old_render(message):
+    def handle_mdj(m):
+        return mdj_emotes.mdj_emote_format(mdj_emotes.mdj_format(m.group(1)))
+
+    pattern = r'(?<!\\)`mdj\s([^`]*)`'
+    if re.search(pattern, message, re.DOTALL) is None:
+        return None
+    return {'content': re.sub(pattern, handle_mdj, message, flags=re.DOTALL)}
+
+
+def old_responsible(message):
+    for lang in runicbabble.lang.langs:
+        if re.match(r'^```mdj(-\d+!?)?\s.*```$', message, re.DOTALL) is not None:
+            return lang
+    return None
+
+
+def new_render(message):
+    return mdj_emotes.render(message)
+
+
+def rate(fn, messages, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for message in messages:
+            fn(message)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(messages) / best
+
+
+def main():
+    Madouji().register()
+    messages = corpus()
+    for label, render, responsible in [('before', old_render, old_responsible),
+                                       ('after', new_render, runicbabble.lang.responsible_language)]:
+        emotes = rate(render, messages)
+        langs = rate(responsible, messages)
+        print(f'{label:7} emote rewrite {emotes:12,.0f} msg/s   language dispatch {langs:12,.0f} msg/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Compares the image encodings for /mdj renders: the size of the uploaded file, the encoding time and the memory of the
+raster being encoded, for the previous RGBA PNG and the formats in `runicbabble.formats.encode`, at several
+compression levels. All of them decode to the same pixels.
+Run from the repository root: python -m benchmarks.render_encoding
+"""
+import io
+import time
+
+from PIL import Image
+
+import runicbabble.discord  # noqa: F401, resolves the import cycle with mdj_emotes
+from runicbabble.formats import encode, mdj_image
+
+MESSAGES = [
+    ('short', 'ayv ymprUvd may progrem', 'none', 8),
+    ('medium', "Vetz pryti nyfti ay u'ud sey. so nao' yt dZenereýtz VIz swrklz Iseli", 'flow', 16),
+    ('long', ' '.join(["Vetz pryti nyfti ay u'ud sey."] * 12), 'optimal', 24),
+]
+
+
+def old_encode(mask):
+    img = Image.new('RGBA', mask.size, (0, 0, 0, 0))
+    img.paste((255, 255, 255), (0, 0), mask)
+    with io.BytesIO() as image_binary:
+        img.save(image_binary, 'PNG')
+        return image_binary.getvalue()
+
+
+def timed(fn, repeat=20):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def main():
+    masks = {name: mdj_image._render_mask(*mdj_image.render_key(msg, 32, wrap, length))
+             for name, msg, wrap, length in MESSAGES}
+
+    variants = [('rgba png (before)', old_encode, 4)]
+    for level in (1, 6, 9):
+        for fmt in ('palette', 'la', 'rgba'):
+            variants.append((f'{fmt} png, level {level}',
+                             lambda mask, fmt=fmt, level=level: encode.encode(mask, format=fmt, compress_level=level),
+                             {'palette': 1, 'la': 2, 'rgba': 4}[fmt]))
+    for method in (0, 4, 6):
+        variants.append((f'webp lossless, method {method}',
+                         lambda mask, method=method: encode.encode(mask, format='webp', compress_level=method), 4))
+
+    print(f'{"":28}' + ''.join(f'{name:>26}' for name in masks))
+    print(f'{"":28}' + ''.join(f'{"bytes":>10}{"ms":>8}{"raster":>8}' for _ in masks))
+    for label, fn, bytes_per_pixel in variants:
+        row = f'{label:28}'
+        for mask in masks.values():
+            data, elapsed = timed(lambda: fn(mask))
+            raster = mask.width * mask.height * bytes_per_pixel
+            row += f'{len(data):>10}{elapsed * 1000:>8.2f}{raster // 1024:>6}KB'
+        print(row)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+"""
+End-to-end check of the render service with several shard processes. Each shard imports the real bot, but a fake
+gateway replaces Discord: it invokes the /mdj command handler with fake interactions and collects the images the
+bot would have sent. Every image is checked against a local render, and throughput and memory of the shards are
+compared with shards that render on their own.
+Run from the repository root: python -m benchmarks.render_service [--shards N] [--requests N]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+PHRASES = ['ayv ymprUvd may progrem', "Vetz pryti nyfti ay u'ud sey.", 'so nao yt dZenereytz VIz swrklz Iseli',
+           'hey dok', 'tEst', 'uoaeyiw UOAEYIW', 'pbtdkgmnqjrl RfFsSxhvVzZ']
+CIRCLE = [
+    {'type': 'ngon', 'radius': 190, 'sides': 7, 'rotation': -1.5708, 'outline': [100, 200, 255], 'width': 3},
+    {'type': 'separator', 'style': 'm', 'color': [100, 200, 255]},
+    {'type': 'text', 'text': '#hey dok', 'size': 60, 'color': [100, 200, 255]},
+    {'type': 'separator', 'style': 'sl', 'color': [100, 200, 255]},
+]
+
+
+class FakeContext:
+    def __init__(self, shard, n):
+        self.channel = f'channel-{shard}'
+        self.author = f'user-{n}'
+
+
+def shard(number, socket, requests, concurrency, results):
+    try:
+        results.put(run_shard(number, socket, requests, concurrency))
+    except Exception as e:
+        results.put({'shard': number, 'error': repr(e)})
+        raise
+
+
+def run_shard(number, socket, requests, concurrency):
+    from runicbabble.config import cfg
+    cfg.db.main.location = 'sqlite://'
+    cfg.discord.attachments.reuse = False
+    cfg.render.pool = 'thread'
+    if socket is not None:
+        cfg.render.service.socket = socket
+    import runicbabble.discord as bot
+
+    sent = {}
+    busy = []
+
+    # the fake gateway: what the bot posts ends up here instead of on Discord
+    async def send_as_webhook(channel, author, priority=None, wait=False, **params):
+        sent[author] = params['file'].fp.getvalue()
+        return True
+
+    async def reply(ctx, *args, **kwargs):
+        if kwargs.get('hidden') and args and args[0] != '\u200d':
+            # rejected because the renderer was busy
+            busy.append(ctx.author)
+        return None
+
+    bot.send_as_webhook = send_as_webhook
+    bot.reply = reply
+    handler = getattr(bot.slash_mdj, 'func', bot.slash_mdj)
+
+    rng = random.Random(number)
+    interactions = [(rng.choice(PHRASES), rng.choice(['none', 'flow', 'optimal']), rng.randint(4, 12))
+                    for _ in range(requests)]
+
+    async def run():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def invoke(n, content, wrap, width):
+            async with semaphore:
+                await handler(FakeContext(number, n), content, wrap, width)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(invoke(n, *interaction) for n, interaction in enumerate(interactions)))
+        elapsed = time.perf_counter() - start
+
+        circle = None
+        if socket is not None:
+            from runicbabble import service
+            circle = await service.client().circle(CIRCLE)
+            await service.client().close()
+        return elapsed, circle
+
+    elapsed, circle = asyncio.run(run())
+    # before the local renders used to check the results
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    from runicbabble.formats import circle as circles, mdj_image
+    wrong = sum(1 for n, (content, wrap, width) in enumerate(interactions)
+                if f'user-{n}' in sent and sent[f'user-{n}'] != mdj_image.render_png(content, 32, wrap, width))
+    if circle is not None and circle != circles.render_spec(CIRCLE):
+        wrong += 1
+    return {'shard': number, 'sent': len(sent), 'busy': len(busy), 'wrong': wrong, 'elapsed': elapsed, 'rss': rss}
+
+
+def run_shards(socket, shards, requests, concurrency):
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    processes = [context.Process(target=shard, args=(n, socket, requests, concurrency, results))
+                 for n in range(shards)]
+    for p in processes:
+        p.start()
+    collected = [results.get() for _ in processes]
+    for p in processes:
+        p.join()
+    failed = [r for r in collected if 'error' in r]
+    if failed:
+        raise RuntimeError(f'Shards failed: {failed}')
+    return collected
+
+
+def report(label, results, requests):
+    sent = sum(r['sent'] for r in results)
+    busy = sum(r['busy'] for r in results)
+    wrong = sum(r['wrong'] for r in results)
+    slowest = max(r['elapsed'] for r in results)
+    rss = max(r['rss'] for r in results) / 1024
+    print(f'{label:24}{sent:>6} sent {busy:>4} busy {wrong:>3} wrong {sent / slowest:>8.0f}/s  '
+          f'max shard RSS {rss:6.1f}MB')
+    return wrong
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--shards', type=int, default=3)
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--concurrency', type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        socket = os.path.join(directory, 'render.sock')
+        server = subprocess.Popen([sys.executable, '-m', 'runicbabble.service', '--socket', socket],
+                                  stderr=subprocess.DEVNULL)
+        try:
+            for _ in range(200):
+                if os.path.exists(socket):
+                    break
+                time.sleep(0.05)
+            else:
+                raise RuntimeError('The render service did not start')
+
+            wrong = report('shards + render service', run_shards(socket, args.shards, args.requests,
+                                                                   args.concurrency), args.requests)
+
+            async def stats():
+                from runicbabble.service import RenderClient
+                client = RenderClient(socket)
+                result = await client.stats()
+                await client.close()
+                return result
+            print(json.dumps(asyncio.run(stats()), indent=2))
+        finally:
+            server.terminate()
+            server.wait()
+
+    wrong += report('shards rendering alone', run_shards(None, args.shards, args.requests, args.concurrency),
+                    args.requests)
+    sys.exit(1 if wrong else 0)
+
+
+if __name__ == '__main__':
+    main()
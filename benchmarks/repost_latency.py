@@ -0,0 +1,119 @@
+"""
+Measures the end-to-end latency of replacing a Madouji message (delete the original, find the webhook, send the
+rewrite) against a fake Discord client with simulated round-trip times, comparing the previous sequential handler
+with the concurrent, per-channel ordered one.
+Run from the repository root: python -m benchmarks.repost_latency
+"""
+import asyncio
+import random
+import statistics
+import time
+from types import SimpleNamespace
+
+from runicbabble.config import cfg
+
+cfg.db.main.location = 'sqlite://'
+
+import runicbabble.discord as bot  # noqa: E402
+
+RTT = 0.05
+JITTER = 0.03
+
+
+async def round_trip():
+    await asyncio.sleep(RTT + random.uniform(0, JITTER))
+
+
+class FakeWebhook:
+    def __init__(self, channel, webhook_id):
+        self.channel = channel
+        self.id = webhook_id
+        self.token = f'token-{webhook_id}'
+        self.name = f'runicbabble-{channel.id}'
+
+    async def send(self, username=None, avatar_url=None, content=None, **kwargs):
+        await round_trip()
+        self.channel.posted.append(content)
+
+
+class FakeChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.name = f'channel-{channel_id}'
+        self.posted = []
+
+    def permissions_for(self, member):
+        return SimpleNamespace(manage_messages=True)
+
+    async def webhooks(self):
+        await round_trip()
+        return []
+
+    async def create_webhook(self, name):
+        await round_trip()
+        return FakeWebhook(self, self.id)
+
+    async def send(self, content=None, **kwargs):
+        await round_trip()
+        self.posted.append(content)
+
+
+class FakeMessage:
+    def __init__(self, message_id, channel, content):
+        self.id = message_id
+        self.channel = channel
+        self.content = content
+        self.guild = SimpleNamespace(id=1, me=None)
+        self.author = SimpleNamespace(display_name='tester', avatar_url='')
+
+    async def delete(self):
+        await round_trip()
+
+
+async def sequential(message, params):
+    # the handler before reposts were pipelined
+    await message.delete()
+    if not await bot.send_as_webhook(message.channel, message.author, **params):
+        await message.channel.send(**params)
+
+
+async def measure(handler, channel_id, count, burst):
+    bot.webhooks.clear()
+    channel = FakeChannel(channel_id)
+    latencies = []
+
+    async def handle(i):
+        message = FakeMessage(i, channel, f'`mdj {i}`')
+        start = time.perf_counter()
+        await handler(message, {'content': str(i)})
+        latencies.append(time.perf_counter() - start)
+
+    if burst:
+        await asyncio.gather(*[handle(i) for i in range(count)])
+    else:
+        for i in range(count):
+            await handle(i)
+    in_order = channel.posted == [str(i) for i in range(count)]
+    return latencies, in_order
+
+
+async def run():
+    # the fake client has no rate limits, so neither should the outbound scheduler
+    bot.scheduler.rates = {}
+    bot.scheduler.default_rate = (1000, 1)
+    print(f'simulated round trip {RTT * 1000:.0f}-{(RTT + JITTER) * 1000:.0f}ms')
+    print(f'{"":26} {"first":>8} {"median":>8} {"max":>8}  in order')
+    for label, burst in [('one at a time', False), ('burst of 20', True)]:
+        for name, handler in [('sequential', sequential), ('pipelined', bot.repost)]:
+            latencies, in_order = await measure(handler, hash((label, name)), 20, burst)
+            print(f'{name + ", " + label:26} {latencies[0] * 1000:6.0f}ms {statistics.median(latencies) * 1000:6.0f}ms '
+                  f'{max(latencies) * 1000:6.0f}ms  {"yes" if in_order else "NO"}')
+
+
+def main(seed=1):
+    random.seed(seed)
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
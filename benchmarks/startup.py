@@ -0,0 +1,110 @@
+"""
+Reports how long the bot takes to start: the import time of `runicbabble.discord` (with the slowest modules),
+how long parsing the YAML config takes with the pure Python and the C loader, and how long the first render takes
+with and without the warmup that runs after `on_ready`. Every measurement runs in a fresh interpreter.
+Run from the repository root: python -m benchmarks.startup [--max-import-ms N]
+With --max-import-ms the exit code is 1 if importing took longer, so it can be used as a CI check.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import yaml
+
+
+def import_times(module, repeat=3):
+    """
+    :return: the fastest total import time of `module` in microseconds, and the (self time, name) of each module
+        imported during that run
+    """
+    best = None
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                                capture_output=True, text=True, check=True)
+        modules = []
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:') or 'self [us]' in line:
+                continue
+            self_time, cumulative, name = line[len('import time:'):].split('|')
+            modules.append((int(self_time), int(cumulative), name.strip()))
+        total = next(cumulative for _, cumulative, name in reversed(modules) if name == module)
+        if best is None or total < best[0]:
+            best = total, [(self_time, name) for self_time, _, name in modules]
+    return best
+
+
+def yaml_files():
+    files = ['logging.yaml']
+    for root, dirs, names in os.walk('config'):
+        files += [os.path.join(root, name) for name in names if name.endswith('.yaml')]
+    return files
+
+
+def parse_time(loader, files, repeat=200):
+    contents = []
+    for path in files:
+        with open(path) as f:
+            contents.append(f.read())
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for content in contents:
+            yaml.load(content, Loader=loader)
+    return (time.perf_counter() - start) / repeat
+
+
+FIRST_RENDER = '''
+import asyncio, time
+import runicbabble.discord
+from runicbabble.config import cfg
+cfg.render.pool = 'thread'
+async def main():
+    if {warm}:
+        await runicbabble.discord.warmup()
+    start = time.perf_counter()
+    from runicbabble.formats import mdj_image
+    await mdj_image.render_cached('`mdj ayv ymprUvd may progrem`', 32)
+    print(time.perf_counter() - start)
+asyncio.run(main())
+'''
+
+
+def first_render(warm):
+    result = subprocess.run([sys.executable, '-c', FIRST_RENDER.format(warm=warm)],
+                            capture_output=True, text=True, check=True)
+    return float(result.stdout.split()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--max-import-ms', type=float, default=None)
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+
+    total, modules = import_times('runicbabble.discord')
+    print(f'import runicbabble.discord: {total / 1000:7.1f}ms')
+    print('slowest modules (self time):')
+    for self_time, name in sorted(modules, reverse=True)[:args.top]:
+        print(f'  {self_time / 1000:7.1f}ms  {name}')
+    render_stack = [name for _, name in modules if name.startswith(('PIL', 'numpy', 'runicbabble.formats.mdj_image'))]
+    print(f'render stack imported at startup: {", ".join(render_stack) or "nothing"}')
+
+    files = yaml_files()
+    print(f'parsing {len(files)} YAML files:')
+    print(f'  SafeLoader:  {parse_time(yaml.SafeLoader, files) * 1000:7.2f}ms')
+    if hasattr(yaml, 'CSafeLoader'):
+        print(f'  CSafeLoader: {parse_time(yaml.CSafeLoader, files) * 1000:7.2f}ms')
+    else:
+        print('  CSafeLoader: not available (PyYAML was built without libyaml)')
+
+    print(f'first render, cold:           {first_render(False) * 1000:7.1f}ms')
+    print(f'first render, after warmup:   {first_render(True) * 1000:7.1f}ms')
+
+    if args.max_import_ms is not None and total / 1000 > args.max_import_ms:
+        print(f'import time exceeds the budget of {args.max_import_ms}ms')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+"""
+Benchmarks for the text and rendering hot paths, with results saved as JSON and compared against a stored baseline.
+
+Every case runs in a fresh process, so caches, imports and peak memory of one case don't affect another. A case is
+called once to warm up (fonts, glyph atlases and compiled patterns are loaded then), and is then timed in rounds
+like `timeit` does. For each case this reports:
+
+- the median and fastest time per call,
+- `alloc`: the peak of Python heap allocations during one call, traced with `tracemalloc` (pixel buffers are
+  allocated by Pillow outside the Python heap and are not included),
+- `rss`: how much the peak resident memory of the process grew while the case ran, from the first call on.
+
+A case regresses if its fastest time (the least noisy one) or its allocations grew by more than `--threshold`
+compared to the baseline; the exit code is then 1. Times depend on the machine, so save a new baseline
+(`--save-baseline`) when switching machines. No Discord credentials are needed.
+
+Run from the repository root: python -m benchmarks.suite [--filter REGEX] [--output results.json]
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import re
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+MESSAGES = {
+    'short': 'ayv ymprUvd may progrem',
+    'medium': "Vetz pryti nyfti ay u'ud sey. so nao' yt dZenereytz VIz swrklz Iseli. ",
+    'long': "Vetz pryti nyfti ay u'ud sey. so nao' yt dZenereytz VIz swrklz Iseli. " * 40,
+}
+
+
+class FakeEmoji:
+    def __init__(self, name, emoji_id):
+        self.name = name
+        self.id = emoji_id
+
+    def __str__(self):
+        return f'<:{self.name}:{self.id}>'
+
+
+class FakeGuild:
+    def __init__(self, guild_id, emojis):
+        self.id = guild_id
+        self.emojis = emojis
+
+
+def _import():
+    import runicbabble.discord  # noqa: F401, resolves the import cycle with mdj_emotes
+    from runicbabble.formats import mdj_emotes
+    return mdj_emotes
+
+
+def case_mdj_format(size):
+    mdj_emotes = _import()
+    message = MESSAGES[size]
+    return lambda: mdj_emotes.mdj_format(message)
+
+
+def case_text_wrap(mode):
+    _import()
+    from runicbabble import fonts, text
+    from runicbabble.formats import atlas, mdj_image
+    message = mdj_image.render_key(MESSAGES['long'], 32)[0]
+    glyphs = atlas.get(fonts.load(fonts.MADOUJI_PATH, 32), mdj_image.charset)
+    if mode == 'optimal':
+        return lambda: text.wrap_text(message, mode, 16 * 32, advance=glyphs.advance)
+    return lambda: text.wrap_text(message, mode, 16)
+
+
+def case_mdj_emote_format(size):
+    mdj_emotes = _import()
+    emojis = [FakeEmoji(name, 10 ** 17 + n) for n, name in enumerate(mdj_emotes.emote_names)]
+    mdj_emotes.update_guild(FakeGuild(1, emojis))
+    message = mdj_emotes.mdj_format(MESSAGES[size])
+    return lambda: mdj_emotes.mdj_emote_format(message, 1)
+
+
+def case_mdj_emotes_render(size):
+    # what on_message does for a message with Madouji in it
+    mdj_emotes = _import()
+    emojis = [FakeEmoji(name, 10 ** 17 + n) for n, name in enumerate(mdj_emotes.emote_names)]
+    mdj_emotes.update_guild(FakeGuild(1, emojis))
+    message = f'look: `mdj {MESSAGES[size]}` and more text'
+    return lambda: mdj_emotes.render(message, 1)
+
+
+def case_mdj_image_render(size, fontsize):
+    _import()
+    from runicbabble.formats import mdj_image
+    message = MESSAGES[size]
+    # `render` does not use the render cache, every call renders and encodes the image again
+    return lambda: mdj_image.render(message, int(fontsize), 'flow', 24)
+
+
+def case_magic_circle(variant):
+    _import()
+    from runicbabble.formats import circle
+    # the configuration `circle.main()` renders
+    mc = circle.example_circle()
+
+    def render():
+        if variant == 'cold':
+            circle.layers.clear()
+            circle.sprites.clear()
+        return mc.render()
+    return render
+
+
+CASES = {
+    **{f'mdj_format/{size}': (case_mdj_format, size) for size in MESSAGES},
+    **{f'text_wrap/{mode}': (case_text_wrap, mode) for mode in ('none', 'flow', 'force', 'optimal')},
+    **{f'mdj_emote_format/{size}': (case_mdj_emote_format, size) for size in MESSAGES},
+    **{f'mdj_emotes.render/{size}': (case_mdj_emotes_render, size) for size in MESSAGES},
+    **{f'mdj_image.render/{size}@{fontsize}': (case_mdj_image_render, size, fontsize)
+       for size in MESSAGES for fontsize in (16, 32, 64)},
+    'MagicCircle.render/cold': (case_magic_circle, 'cold'),
+    'MagicCircle.render/cached': (case_magic_circle, 'cached'),
+}
+
+
+def measure(name, repeat, budget):
+    """
+    Run one case in this process.
+
+    :param budget: stop adding rounds after this many seconds, once there are at least three
+    :return: a dict of results
+    """
+    setup, *args = CASES[name]
+    fn = setup(*args)
+    gc.collect()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    fn()
+
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    rounds = []
+    start = time.perf_counter()
+    while len(rounds) < repeat and (len(rounds) < 3 or time.perf_counter() - start < budget):
+        rounds.append(timer.timeit(number) / number)
+
+    tracemalloc.start()
+    fn()
+    _, alloc = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # ru_maxrss is in KiB on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {'median': statistics.median(rounds), 'min': min(rounds), 'rounds': len(rounds), 'number': number,
+            'alloc': alloc, 'rss': (peak_rss - rss_before) * 1024, 'peak_rss': peak_rss * 1024}
+
+
+def run_case(name, repeat, budget):
+    # a fixed hash seed keeps the order of sets and dicts of strings, and so the timings, the same between runs
+    env = {**os.environ, 'PYTHONHASHSEED': '0'}
+    out = subprocess.run([sys.executable, '-m', 'benchmarks.suite', '--run-case', name, '--repeat', str(repeat),
+                          '--budget', str(budget)], capture_output=True, text=True, env=env)
+    if out.returncode != 0:
+        raise RuntimeError(f'Benchmark {name} failed:\n{out.stderr}')
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def environment():
+    import PIL
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {'python': platform.python_version(), 'pillow': PIL.__version__, 'platform': platform.platform(),
+            'cpus': os.cpu_count(), 'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def compare(results, baseline, threshold):
+    """
+    :return: a list of (case, measure, ratio) for every measure that grew by more than `threshold`
+    """
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        for key in ('min', 'alloc'):
+            # tiny allocations vary with interpreter internals
+            if key == 'alloc' and max(result[key], before[key]) < 4096:
+                continue
+            ratio = result[key] / before[key] if before[key] else float('inf')
+            if ratio > 1 + threshold:
+                regressions.append((name, key, ratio))
+    return regressions
+
+
+def _size(n):
+    for unit in ('B', 'KB', 'MB'):
+        if abs(n) < 1024 or unit == 'MB':
+            return f'{n:.0f}{unit}' if unit == 'B' else f'{n:.1f}{unit}'
+        n /= 1024
+
+
+def _time(seconds):
+    if seconds < 1e-3:
+        return f'{seconds * 1e6:.1f}us'
+    if seconds < 1:
+        return f'{seconds * 1e3:.2f}ms'
+    return f'{seconds:.2f}s'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.suite', description=__doc__.split('\n')[1])
+    parser.add_argument('--filter', default=None, help='only run the cases whose name matches this regex')
+    parser.add_argument('--output', default='benchmark-results.json', help='where to save the results')
+    parser.add_argument('--baseline', default=BASELINE, help='the results to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    # timings of the sub-millisecond cases vary by about a third between runs on a busy machine
+    parser.add_argument('--threshold', type=float, default=0.5,
+                        help='the relative growth that counts as a regression (default 0.5)')
+    parser.add_argument('--repeat', type=int, default=7, help='the most rounds to time per case')
+    parser.add_argument('--budget', type=float, default=2.0, help='the seconds to spend on the rounds of a case')
+    parser.add_argument('--run-case', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--list', action='store_true', help='list the cases and exit')
+    args = parser.parse_args(argv)
+
+    if args.run_case is not None:
+        print(json.dumps(measure(args.run_case, args.repeat, args.budget)))
+        return 0
+    names = [name for name in CASES if args.filter is None or re.search(args.filter, name)]
+    if args.list:
+        print('\n'.join(names))
+        return 0
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    print(f'{"case":32}{"median":>10}{"min":>10}{"alloc":>10}{"rss":>10}{"vs baseline":>13}')
+    results = {}
+    for name in names:
+        result = results[name] = run_case(name, args.repeat, args.budget)
+        before = baseline.get(name)
+        change = f'{result["min"] / before["min"] - 1:+.0%}' if before else '-'
+        print(f'{name:32}{_time(result["median"]):>10}{_time(result["min"]):>10}{_size(result["alloc"]):>10}'
+              f'{_size(result["rss"]):>10}{change:>13}')
+
+    document = {'environment': environment(), 'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(document, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(document, f, indent=2)
+        print(f'Saved the baseline to {args.baseline}')
+        return 0
+
+    regressions = compare(results, baseline, args.threshold)
+    for name, key, ratio in regressions:
+        print(f'REGRESSION {name}: {key} is {ratio:.2f}x the baseline')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
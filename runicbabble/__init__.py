@@ -16,11 +16,24 @@ runicbabble.config.from_directory('config')
 runicbabble.config.from_env_mapping({
     'discord': {
         'bot_token': 'BOT_TOKEN',
-        'sync_slash': 'SYNC_SLASH'
+        'sync_slash': 'SYNC_SLASH',
+        'admins': 'ADMIN_IDS',
+        'shards': {
+            'count': 'SHARD_COUNT',
+            'ids': 'SHARD_IDS'
+        }
+    },
+    'render': {
+        'service': {
+            'socket': 'RENDER_SOCKET'
+        }
     },
     'db': {
         'main': {
             'location': 'DB_LOCATION'
         }
+    },
+    'metrics': {
+        'port': 'METRICS_PORT'
     }
 })
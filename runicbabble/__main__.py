@@ -5,7 +5,7 @@ import yaml
 
 # Read the logger configuration from a config file
 with open('logging.yaml', 'r') as lf:
-    log_cfg = yaml.safe_load(lf.read())
+    log_cfg = yaml.load(lf, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
 logging.config.dictConfig(log_cfg)
 
 from runicbabble import discord
@@ -0,0 +1,146 @@
+import asyncio
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    A thread-safe least-recently-used cache. Entries are evicted once more than `maxsize` entries are stored, or,
+    if a `weigh` function is given, once the summed weight of all entries exceeds `maxweight`.
+    Hit, miss and eviction counters are kept so the effectiveness of the cache can be observed.
+    """
+
+    def __init__(self, maxsize=128, weigh=None, maxweight=None):
+        self.maxsize = maxsize
+        self.weigh = weigh
+        self.maxweight = maxweight
+
+        self._data = OrderedDict()
+        self._weights = {}
+        self._weight = 0
+        self._lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    @property
+    def weight(self):
+        return self._weight
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._data:
+                self._discard(key)
+            weight = self.weigh(value) if self.weigh is not None else 1
+            if self.maxweight is not None and weight > self.maxweight:
+                # would evict everything else and still not fit
+                return value
+            self._data[key] = value
+            self._weights[key] = weight
+            self._weight += weight
+            self._shrink()
+            return value
+
+    def get_or_create(self, key, factory):
+        """
+        Return the cached value for `key`, calling `factory()` to create and store it on a miss.
+        """
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+        value = factory()
+        with self._lock:
+            if key in self._data:
+                # someone else created it in the meantime, keep the first one
+                return self._data[key]
+            return self.put(key, value)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            value = self._data[key]
+            self._discard(key)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._weights.clear()
+            self._weight = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'weight': self._weight,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / total if total else 0.0
+            }
+
+    def _discard(self, key):
+        del self._data[key]
+        self._weight -= self._weights.pop(key)
+
+    def _shrink(self):
+        while self._data and ((self.maxsize is not None and len(self._data) > self.maxsize)
+                              or (self.maxweight is not None and self._weight > self.maxweight)):
+            key = next(iter(self._data))
+            self._discard(key)
+            self.evictions += 1
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key: while a call for a key is in flight, further callers await the
+    result of that call instead of starting their own.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def do(self, key, produce):
+        """
+        Await `produce()` for this key, or join the call that is already running for it.
+
+        :param key: identifies calls that are interchangeable
+        :param produce: a function returning an awaitable that computes the result
+        :return: the result of the (shared) call
+        """
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(produce())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            self.coalesced += 1
+        # a cancelled waiter must not cancel the work the other waiters depend on
+        return await asyncio.shield(task)
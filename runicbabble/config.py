@@ -1,115 +1,165 @@
+import copy
 import yaml
 import logging
 import os
 import re
+import threading
+from types import MappingProxyType
 
 log = logging.getLogger(__name__)
 
+# the C implementation of the YAML parser is much faster, but only available if libyaml was found at install time
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+class Snapshot:
+    """
+    An immutable, compiled view of the merged configuration. Every value in the tree is stored under its full path,
+    so looking a setting up is a single dict access no matter how deeply it is nested.
+    """
+
+    def __init__(self, tree):
+        self.tree = _freeze(tree)
+        self.values = {(): self.tree}
+        _flatten(self.tree, (), self.values)
+
+    def lookup(self, path):
+        return self.values[path]
+
+    def get(self, dotted, default=None):
+        """
+        Look a setting up by its dotted name, like `snapshot.get('discord.sync_slash')`.
+        """
+        return self.values.get(tuple(dotted.split('.')), default)
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(v) for key, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _flatten(value, path, result):
+    if isinstance(value, MappingProxyType):
+        items = value.items()
+    elif isinstance(value, tuple):
+        items = enumerate(value)
+    else:
+        return
+    for key, v in items:
+        result[path + (key,)] = v
+        _flatten(v, path + (key,), result)
+
 
 class PathChainer:
     def __init__(self, parent, name=None, attr_access=False):
         self.__dict__['_name'] = name
         self.__dict__['_parent'] = parent
         self.__dict__['_attr_access'] = attr_access
+        self.__dict__['_children'] = {}
+        if isinstance(parent, PathChainer):
+            self.__dict__['_path'] = parent._path + (name,)
+            self.__dict__['_joined'] = parent._joined + (f'.{name}' if attr_access else f'[\'{name}\']')
+        else:
+            self.__dict__['_path'] = ()
+            self.__dict__['_joined'] = name
 
     def __repr__(self):
-        _, joined = self.__follow_path__(*self.__trace_path__())
-        return f"PathChainer {joined}"
+        return f"PathChainer {self._joined}"
+
+    def _child(self, name, attr_access):
+        # accessors are created once per path and then reused
+        key = (name, attr_access)
+        try:
+            return self._children[key]
+        except KeyError:
+            child = self._children[key] = PathChainer(self, name, attr_access=attr_access)
+            return child
 
     def __getattr__(self, name):
-        return PathChainer(self, name, attr_access=True)
+        return self._child(name, True)
 
     def __setattr__(self, key, value):
-        root, path_components = PathChainer(self, key, attr_access=True).__trace_path__()
-
-        cursor, _ = self.__follow_path__(root, path_components, create_if_missing=True)
-
-        name, _ = path_components[-1]
-        cursor[name] = value
-        return
+        set_value(self._path + (key,), value)
 
     def __getitem__(self, name):
-        return PathChainer(self, name)
+        return self._child(name, False)
 
     def __setitem__(self, key, value):
-        root, path_components = PathChainer(self, key, attr_access=False).__trace_path__()
-
-        cursor, _ = self.__follow_path__(root, path_components, create_if_missing=True)
-
-        name, _ = path_components[-1]
-        cursor[name] = value
-        return
+        set_value(self._path + (key,), value)
 
     def __call__(self, *args, **kwargs):
-        root, path_components = self.__trace_path__()
-
         try:
-            cursor, joined = self.__follow_path__(root, path_components)
-            if cursor == None:
-                return root._parent
-
-            name, attr_access = path_components[-1]
-
-            if name not in cursor:
-                raise KeyError(joined)
-            return cursor[name]
+            return _snapshot.values[self._path]
         except KeyError:
             if 'default' in kwargs:
                 return kwargs['default']
             if len(args) > 0:
                 return args[0]
-            raise
+            raise KeyError(self._joined)
 
     def exists(self):
-        try:
-            self()
-            return True
-        except KeyError:
-            return False
+        return self._path in _snapshot.values
+
 
-    def __trace_path__(self):
-        newpath = []
-        current = self
-        while isinstance(current._parent, PathChainer):
-            newpath.insert(0, (current._name, current._attr_access))
-            current = current._parent
-        return current, newpath
-
-    @staticmethod
-    def __follow_path__(root, path_components, create_if_missing=False):
-        joined = root._name
-        cursor = root._parent
-        for name, attr_access in path_components[:-1]:
-            joined += f'.{name}' if attr_access else f'[\'{name}\']'
-            if name not in cursor:
-                if create_if_missing:
-                    cursor[name] = {}
-                else:
-                    raise KeyError(joined)
-            cursor = cursor[name]
-            if type(cursor) not in [dict, list]:
-                raise TypeError(f'{joined}: not a dict or list')
-        if len(path_components) > 0:
-            name, attr_access = path_components[-1]
-            joined += f'.{name}' if attr_access else f'[\'{name}\']'
-            return cursor, joined
-        return None, joined
-
-
-cfg = PathChainer({}, 'cfg')
+cfg = PathChainer(None, 'cfg')
+
+# the merged configuration that the snapshot is compiled from, and the sources it was merged from in order, so it
+# can be rebuilt when files change
+_raw = {}
+_sources = []
+_snapshot = Snapshot(_raw)
+_lock = threading.RLock()
+
+
+def snapshot():
+    return _snapshot
+
+
+def freeze():
+    """
+    Compile the merged configuration into a new snapshot and make it the current one.
+    """
+    global _snapshot
+    _snapshot = Snapshot(_raw)
+    return _snapshot
+
+
+def _add_source(load):
+    with _lock:
+        _sources.append(load)
+        merge_dicts(_raw, load())
+        freeze()
+
+
+def set_value(path, value):
+    def load():
+        content = {}
+        cursor = content
+        for name in path[:-1]:
+            cursor = cursor.setdefault(name, {})
+        cursor[path[-1]] = value
+        return content
+    _add_source(load)
 
 
 def merge_dicts(base, new):
-    result = {**base}
+    """
+    Merge `new` into `base` in place: nested dicts are merged recursively, other values are replaced.
+    """
     for key in new:
         if type(new[key]) == dict and key in base and type(base[key]) == dict:
-            result[key] = merge_dicts(base[key], new[key])
-        result[key] = new[key]
-    return result
+            merge_dicts(base[key], new[key])
+        else:
+            # copied, so later merges never modify a source's own dicts
+            base[key] = copy.deepcopy(new[key])
+    return base
 
 
 def from_dict(content):
-    cfg.__dict__['_parent'] = merge_dicts(cfg._parent, content)
+    _add_source(lambda: content)
 
 
 def from_env_var(key, env_var):
@@ -128,30 +178,88 @@ def map2dict(mapping, source=os.environ):
 
 
 def from_env_mapping(mapping):
-    from_dict(map2dict(mapping))
+    _add_source(lambda: map2dict(mapping))
 
 
-def from_file(path, type='yaml'):
+def read_file(path, type='yaml'):
     try:
         if type == 'yaml':
             with open(path, 'r') as lf:
-                file_content = yaml.safe_load(lf.read())
-            from_dict(file_content)
+                return yaml.load(lf, Loader=Loader) or {}
         else:
             log.warning(f'Config file type "{type}" not implemented: skipping file "{path}"')
+            return {}
     except Exception:
         log.error(f'Failed to read "{path}" as a config file of type "{type}"')
         raise
 
 
-def from_directory(path, type=None, filter=r'.*\.yaml'):
-    log.info(f'Reading config from directory {path}')
-    for f in os.listdir(path):
+def from_file(path, type='yaml'):
+    _add_source(lambda: read_file(path, type))
+
+
+def read_directory(path, type=None, filter=r'.*\.yaml'):
+    result = {}
+    for f in sorted(os.listdir(path)):
         t = type or 'yaml'
         p = os.path.join(path, f)
-        if not re.match(filter, p):
-            continue
-        if os.path.isfile(p):
-            from_file(p, type=t)
+        if os.path.isfile(p) and re.match(filter, p):
+            merge_dicts(result, read_file(p, type=t))
         if os.path.isdir(p):
-            from_directory(p, type)
+            merge_dicts(result, read_directory(p, type, filter))
+    return result
+
+
+def from_directory(path, type=None, filter=r'.*\.yaml'):
+    log.info(f'Reading config from directory {path}')
+    _add_source(lambda: read_directory(path, type, filter))
+
+
+def reload():
+    """
+    Re-read all config sources and atomically swap in the resulting snapshot. If any source fails to load, the
+    current configuration stays in place.
+    """
+    global _raw
+    with _lock:
+        raw = {}
+        try:
+            for load in _sources:
+                merge_dicts(raw, load())
+        except Exception:
+            log.exception('Reloading the configuration failed, keeping the previous one')
+            return False
+        _raw = raw
+        freeze()
+    log.info('Configuration reloaded')
+    return True
+
+
+def _modification_times(path):
+    times = {}
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            p = os.path.join(root, f)
+            try:
+                times[p] = os.stat(p).st_mtime_ns
+            except OSError:
+                pass
+    return times
+
+
+def watch(path='config', interval=5.0):
+    """
+    Start a background thread that reloads the configuration whenever a file below `path` changes.
+    """
+    def run():
+        seen = _modification_times(path)
+        while not stop.wait(interval):
+            current = _modification_times(path)
+            if current != seen:
+                seen = current
+                reload()
+
+    stop = threading.Event()
+    thread = threading.Thread(target=run, name='config-watch', daemon=True)
+    thread.start()
+    return stop
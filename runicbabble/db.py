@@ -0,0 +1,49 @@
+import logging
+import os
+import sqlite3
+
+from runicbabble.config import cfg
+
+log = logging.getLogger(__name__)
+
+schema = [
+    '''CREATE TABLE IF NOT EXISTS webhooks (
+        channel_id INTEGER PRIMARY KEY,
+        webhook_id INTEGER NOT NULL,
+        token TEXT NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS attachments (
+        render_key TEXT PRIMARY KEY,
+        url TEXT NOT NULL,
+        created REAL NOT NULL
+    )''',
+]
+
+_connection = None
+
+
+def sqlite_path(location):
+    """
+    Convert a database URL like `sqlite:///runic.sqlite` into a path sqlite3 can open.
+    """
+    if location in ('sqlite://', 'sqlite:///:memory:'):
+        return ':memory:'
+    if not location.startswith('sqlite:///'):
+        raise ValueError(f'Unsupported database location "{location}": only sqlite:/// URLs are supported')
+    return location[len('sqlite:///'):]
+
+
+def connection():
+    """
+    The shared connection to the main database (`db.main.location`), created with all tables on first use.
+    """
+    global _connection
+    if _connection is None:
+        path = sqlite_path(cfg.db.main.location('sqlite:///runic.sqlite'))
+        log.info(f'Opening database {path}')
+        if path != ':memory:' and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        _connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        for statement in schema:
+            _connection.execute(statement)
+    return _connection
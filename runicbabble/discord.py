@@ -1,13 +1,21 @@
+import asyncio
+import hashlib
+import importlib
 import io
+import time
+import urllib.parse
+from collections import defaultdict
 
+import aiohttp
 import discord
 from discord_slash import SlashCommand, SlashCommandOptionType, SlashContext
 import logging
 
 from discord_slash.utils.manage_commands import create_option, create_choice
 
-import runicbabble.formats.mdj_image
 import runicbabble.formats.mdj_emotes
+import runicbabble.config
+from runicbabble import db, metrics, outbound, service, workers
 from runicbabble.config import cfg
 
 log = logging.getLogger(__name__)
@@ -17,9 +25,35 @@ intents = discord.Intents.default()
 #
 # Discord stuff
 #
-client = discord.Client(intents=intents)
+if cfg.discord.shards.count(None) is None:
+    client = discord.Client(intents=intents)
+else:
+    # every process runs the shards in `discord.shards.ids` (like "0,1"), or all of them; run the render service
+    # (`python -m runicbabble.service`) so the shard processes don't each render on their own
+    shard_ids = cfg.discord.shards.ids(None)
+    if isinstance(shard_ids, str):
+        shard_ids = [int(i) for i in shard_ids.split(',')]
+    client = discord.AutoShardedClient(intents=intents, shard_count=int(cfg.discord.shards.count()),
+                                       shard_ids=shard_ids)
 slash = SlashCommand(client, sync_commands=True)  # Declares slash commands through the client.
 
+# all requests that post or delete messages go through here, see `runicbabble.outbound`
+scheduler = outbound.OutboundScheduler(rates={
+    'channel': (5, 5),
+    'webhook': (5, 2),
+    'delete': (5, 1),
+    'interaction': (5, 1)
+}, max_depth=int(cfg.discord.outbound.max_depth(100)))
+metrics.register('outbound', scheduler.stats)
+
+
+async def reply(ctx: SlashContext, *args, **kwargs):
+    """
+    Respond to a slash command through the scheduler, ahead of any other traffic.
+    """
+    return await scheduler.submit(('interaction', ctx.interaction_id), lambda: ctx.send(*args, **kwargs),
+                                  outbound.SLASH, bounded=False)
+
 
 @client.event
 async def on_ready():
@@ -28,58 +62,284 @@ async def on_ready():
     activity = discord.Activity(name='the whispers of the otherworld', type=discord.ActivityType.listening)
     await client.change_presence(activity=activity)
 
+    load_webhooks()
+
     await runicbabble.formats.mdj_emotes.init_emotes()
 
+    asyncio.ensure_future(warmup())
+    await start_metrics()
 
-webhooks = {}
 
+_metrics_server = None
 
-async def send_as_webhook(channel: discord.TextChannel, author: discord.User, **kwargs):
+
+async def start_metrics():
     """
-    Attempts to send a message using webhooks. The bot can use this to send messages under a specified user's name,
-    allowing selfbot-like capabilities.
+    Serve the metrics for Prometheus if `metrics.port` is set, see `runicbabble.metrics`.
+    """
+    global _metrics_server
+    port = cfg.metrics.port(None)
+    if _metrics_server is not None or port is None:
+        return
+    try:
+        _metrics_server = await metrics.serve(cfg.metrics.host('127.0.0.1'), int(port))
+    except OSError:
+        log.exception(f'Could not serve metrics on port {port}')
 
-    :param channel: the channel to send the message to
-    :param author: the user under whose name to send the message
-    :param kwargs: all parameters to be passed to the actual `send` method
-    :return: True if the send succeeded, False otherwise
+
+async def warmup():
     """
+    Import the rendering code and prepare fonts and glyph atlases in the background, after the bot is already online.
+    The render stack is only imported here or on the first /mdj request, which keeps startup short.
+    """
+    start = time.perf_counter()
     try:
+        loop = asyncio.get_running_loop()
+        mdj_image = await loop.run_in_executor(None, importlib.import_module, 'runicbabble.formats.mdj_image')
+        sizes = tuple(cfg.render.warmup_sizes([32]))
+        # rendering happens in the workers, so that's where the fonts have to be loaded
+        pool = workers.pool()
+        await asyncio.gather(*(pool.run(mdj_image.warmup, sizes) for _ in range(pool.workers)))
+    except Exception:
+        log.exception('Warming up the renderer failed')
+        return
+    log.info(f'Renderer warmed up in {time.perf_counter() - start:.2f}s')
+
+
+webhooks = {}
+webhook_locks = defaultdict(asyncio.Lock)
+_http_session = None
+metrics.register('webhooks', lambda: len(webhooks))
+
+
+def http_session():
+    global _http_session
+    if _http_session is None:
+        _http_session = aiohttp.ClientSession()
+    return _http_session
+
+
+def load_webhooks():
+    """
+    Restore the webhooks remembered in the database, without any API calls.
+    """
+    adapter = discord.AsyncWebhookAdapter(http_session())
+    for channel_id, webhook_id, token in db.connection().execute('SELECT channel_id, webhook_id, token FROM webhooks'):
+        if channel_id not in webhooks:
+            webhooks[channel_id] = discord.Webhook.partial(webhook_id, token, adapter=adapter)
+    log.info(f'Loaded {len(webhooks)} known webhooks')
+
+
+def _remember_webhook(channel_id, webhook: discord.Webhook):
+    webhooks[channel_id] = webhook
+    if webhook.token is not None:
+        db.connection().execute('INSERT OR REPLACE INTO webhooks (channel_id, webhook_id, token) VALUES (?, ?, ?)',
+                                (channel_id, webhook.id, webhook.token))
+
+
+def _forget_webhook(channel_id):
+    webhooks.pop(channel_id, None)
+    db.connection().execute('DELETE FROM webhooks WHERE channel_id = ?', (channel_id,))
+
+
+async def get_webhook(channel: discord.TextChannel):
+    """
+    Get the webhook the bot uses in a channel, looking for an existing one or creating it if it isn't known yet.
+    Only one lookup runs per channel at a time, so concurrent messages can't create duplicate webhooks.
+    """
+    async with webhook_locks[channel.id]:
         if channel.id not in webhooks:
             whs = await channel.webhooks()
             for wh in whs:
                 wh: discord.Webhook
                 if wh.name == f'runicbabble-{channel.id}':
                     log.info(f'Webhook for channel "{channel.name}" ({channel.id}) was found, reusing')
-                    webhooks[channel.id] = wh
+                    _remember_webhook(channel.id, wh)
                     break
             else:
                 log.info(f'No existing webhook for channel "{channel.name}" ({channel.id}) was found, creating one')
-                webhooks[channel.id] = await channel.create_webhook(name=f'runicbabble-{channel.id}')
-        webhook: discord.Webhook = webhooks[channel.id]
+                _remember_webhook(channel.id, await channel.create_webhook(name=f'runicbabble-{channel.id}'))
+        return webhooks[channel.id]
+
+
+async def send_as_webhook(channel: discord.TextChannel, author: discord.User, priority=outbound.REWRITE, **kwargs):
+    """
+    Attempts to send a message using webhooks. The bot can use this to send messages under a specified user's name,
+    allowing selfbot-like capabilities.
+
+    :param channel: the channel to send the message to
+    :param author: the user under whose name to send the message
+    :param priority: the priority of the message in the outbound scheduler
+    :param kwargs: all parameters to be passed to the actual `send` method
+    :return: the sent message if `wait=True` was passed, True if the send succeeded otherwise, False if it failed
+    """
+    async def send(webhook: discord.Webhook):
+        # includes the time spent waiting for the rate limit
+        with metrics.timed('upload'):
+            return await scheduler.submit(('webhook', webhook.id),
+                                          lambda: webhook.send(username=author.display_name,
+                                                               avatar_url=author.avatar_url, **kwargs),
+                                          priority, bounded=False)
+
+    try:
+        with metrics.timed('webhook_lookup'):
+            webhook: discord.Webhook = await get_webhook(channel)
 
         try:
-            await webhook.send(username=author.display_name, avatar_url=author.avatar_url, **kwargs)
+            return await send(webhook) or True
         except discord.NotFound:
-            log.info(f'Previously known webhook for channel "{channel.name}" ({channel.id}) was deleated, recreating')
-            webhooks[channel.id] = await channel.create_webhook(name=f'runicbabble-{channel.id}')
-            await webhooks[channel.id].send(username=author.display_name, avatar_url=author.avatar_url, **kwargs)
-        return True
+            async with webhook_locks[channel.id]:
+                # another message may already have replaced the stale webhook
+                if webhooks.get(channel.id) is webhook:
+                    metrics.count('webhooks_recreated')
+                    log.info(f'Previously known webhook for channel "{channel.name}" ({channel.id}) was deleted, '
+                             f'recreating')
+                    _forget_webhook(channel.id)
+                    _remember_webhook(channel.id, await channel.create_webhook(name=f'runicbabble-{channel.id}'))
+            return await send(webhooks[channel.id]) or True
     except discord.Forbidden:
+        metrics.count('webhooks_forbidden')
         return False
 
 
+def attachment_key(render_key):
+    """
+    The key an uploaded render is remembered by; the same render in another image format is a different file.
+    """
+    return hashlib.sha256(repr((render_key, cfg.render.format('palette'))).encode()).hexdigest()
+
+
+def _attachment_expired(url, created):
+    if time.time() - created > float(cfg.discord.attachments.max_age(86400)):
+        return True
+    # signed CDN URLs carry their expiry time as a hex timestamp
+    expires = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query).get('ex')
+    if expires:
+        try:
+            return time.time() > int(expires[0], 16) - 60
+        except ValueError:
+            return True
+    return False
+
+
+async def known_attachment(key):
+    """
+    The CDN URL of an earlier upload of the same render, or None if there is none or it can't be used anymore.
+    """
+    row = db.connection().execute('SELECT url, created FROM attachments WHERE render_key = ?', (key,)).fetchone()
+    if row is None:
+        return None
+    url, created = row
+    if _attachment_expired(url, created):
+        _forget_attachment(key)
+        return None
+    if cfg.discord.attachments.verify(True):
+        try:
+            async with http_session().head(url, timeout=aiohttp.ClientTimeout(total=5)) as response:
+                if response.status != 200:
+                    log.info(f'Remembered attachment {url} is gone ({response.status}), uploading again')
+                    _forget_attachment(key)
+                    return None
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            # can't tell whether the URL still works, so upload to be safe
+            return None
+    return url
+
+
+def _remember_attachment(key, message):
+    if isinstance(message, discord.Message) and message.attachments:
+        db.connection().execute('INSERT OR REPLACE INTO attachments (render_key, url, created) VALUES (?, ?, ?)',
+                                (key, message.attachments[0].url, time.time()))
+
+
+def _forget_attachment(key):
+    db.connection().execute('DELETE FROM attachments WHERE render_key = ?', (key,))
+
+
+@client.event
+async def on_guild_emojis_update(guild: discord.Guild, before, after):
+    runicbabble.formats.mdj_emotes.update_guild(guild, after)
+
+
+@client.event
+async def on_guild_join(guild: discord.Guild):
+    runicbabble.formats.mdj_emotes.update_guild(guild)
+
+
+@client.event
+async def on_guild_remove(guild: discord.Guild):
+    runicbabble.formats.mdj_emotes.remove_guild(guild)
+
+
 @client.event
 async def on_message(message: discord.Message):
-    params = runicbabble.formats.mdj_emotes.render(message.content)
+    guild_id = message.guild.id if message.guild is not None else None
+    with metrics.timed('message_scan'):
+        params = runicbabble.formats.mdj_emotes.render(message.content, guild_id)
     if params is not None:
-        await message.delete()
-        if not await send_as_webhook(message.channel, message.author, **params):
+        with metrics.request('repost'):
+            await repost(message, params)
+
+
+# per channel, the future that is resolved once the latest repost has been sent
+_repost_tails = {}
+
+
+def _can_delete(message: discord.Message):
+    if message.guild is None:
+        return False
+    return message.channel.permissions_for(message.guild.me).manage_messages
+
+
+def _ignore_result(task: asyncio.Future):
+    # errors of background lookups resurface where the result is actually needed
+    if not task.cancelled():
+        task.exception()
+
+
+async def repost(message: discord.Message, params):
+    """
+    Replace a message with a rewritten version sent under the author's name. Deleting the original, resolving the
+    channel's webhook and sending run concurrently, but the replacements in a channel are always sent in the order
+    in which the originals arrived.
+    """
+    if not _can_delete(message):
+        log.debug(f'Missing permission to delete messages in channel {message.channel.id}, not reposting')
+        return
+    try:
+        scheduler.check_capacity(outbound.REWRITE)
+    except outbound.QueueFull:
+        log.warning(f'Outbound queue is full, not reposting message {message.id}')
+        metrics.count('repost_rejected')
+        return
+
+    channel = message.channel
+    loop = asyncio.get_running_loop()
+    previous = _repost_tails.get(channel.id)
+    turn = loop.create_future()
+    _repost_tails[channel.id] = turn
+
+    deletion = asyncio.ensure_future(scheduler.submit(('delete', channel.id), message.delete, bounded=False))
+    lookup = asyncio.ensure_future(get_webhook(channel))
+    lookup.add_done_callback(_ignore_result)
+    try:
+        if previous is not None:
+            await previous
+        if not await send_as_webhook(channel, message.author, **params):
             # if webhooks don't work, just send it yourself
-            await message.channel.send(**params)
+            await scheduler.submit(('channel', channel.id), lambda: channel.send(**params), bounded=False)
+    finally:
+        turn.set_result(None)
+        if _repost_tails.get(channel.id) is turn:
+            del _repost_tails[channel.id]
+        try:
+            await deletion
+        except discord.NotFound:
+            log.debug(f'Message {message.id} was already deleted')
 
 guild_ids = [854621868002377738, 761260439207936012, 751477559656710155]  # Put your server ID in this array.
-if cfg.discord.sync_slash('False').lower() == 'true':
+# the setting is a bool in YAML files, but a string when it comes from the environment
+if str(cfg.discord.sync_slash('False')).lower() == 'true':
     guild_ids = None
 
 
@@ -101,33 +361,135 @@ if cfg.discord.sync_slash('False').lower() == 'true':
                          create_choice(name="none",  value="none"),
                          create_choice(name="flow",  value="flow"),
                          create_choice(name="force", value="force"),
+                         create_choice(name="optimal", value="optimal"),
                      ]
                  ),
                  create_option(
                     name="line-width",
-                    description="max amount of characters in a line",
+                    description="max amount of characters in a line, "
+                                "or for optimal wrapping the line width in em (font sizes)",
                     option_type=SlashCommandOptionType.INTEGER,
                     required=False
                  )
              ],
              guild_ids=guild_ids)
+@metrics.instrumented('slash_mdj')
 async def slash_mdj(ctx: SlashContext, content: str, wrap: str = 'none', line_width: int = 8):
-    params = runicbabble.formats.mdj_image.render(content, 32, wrap, line_width)
-    if await send_as_webhook(ctx.channel, ctx.author, **params):
-        await ctx.send('\u200d', hidden=True)
+    try:
+        scheduler.check_capacity(outbound.SLASH)
+    except outbound.QueueFull:
+        log.warning('Outbound queue is full, rejecting /mdj request')
+        metrics.count('slash_mdj_rejected')
+        # bypass the full queue, or the user gets no answer at all
+        await ctx.send('The runes are busy right now, please try again in a moment.', hidden=True)
+        return
+    # Discord only waits 3 seconds for an answer, rendering can take longer. The answer stays hidden, the images are
+    # sent separately
+    await scheduler.submit(('interaction', ctx.interaction_id), lambda: ctx.defer(hidden=True), outbound.SLASH,
+                           bounded=False)
+    from runicbabble.formats import mdj_image
+    key = attachment_key(mdj_image.render_key(content, 32, wrap, line_width))
+    # an image that was uploaded before is linked to instead of rendered and uploaded again
+    url = None
+    if cfg.discord.attachments.reuse(True):
+        with metrics.timed('attachment_lookup'):
+            url = await known_attachment(key)
+    if url is not None:
+        metrics.count('attachments_reused')
+        pages = [{'embed': discord.Embed().set_image(url=url)}]
     else:
-        # if webhooks don't work, just send it yourself
-        await ctx.send(**params)
+        try:
+            # long messages come as several images, possibly spread over several messages
+            with metrics.timed('render'):
+                pages = await mdj_image.render_cached(content, 32, wrap, line_width)
+        except workers.Saturated:
+            log.warning('Render pool is saturated, rejecting /mdj request')
+            metrics.count('slash_mdj_rejected')
+            await reply(ctx, 'The runes are busy right now, please try again in a moment.', hidden=True)
+            return
+        except asyncio.TimeoutError:
+            log.warning(f'Rendering /mdj request of length {len(content)} timed out')
+            metrics.count('slash_mdj_timeouts')
+            await reply(ctx, 'That message took too long to render, try a shorter one.', hidden=True)
+            return
+        except service.ServiceError as e:
+            log.error(f'The render service failed to render /mdj request of length {len(content)}: {e}')
+            metrics.count('slash_mdj_failed')
+            await reply(ctx, 'Something went wrong while rendering that message.', hidden=True)
+            return
+    # only single images are linked to later
+    remember = url is None and len(pages) == 1 and 'file' in pages[0]
+    via_webhook = True
+    message = None
+    for params in pages:
+        if via_webhook:
+            message = await send_as_webhook(ctx.channel, ctx.author, priority=outbound.SLASH, wait=remember,
+                                            **params)
+            via_webhook = bool(message)
+        if not via_webhook:
+            if ctx.deferred:
+                # the first reply would fill in the hidden answer, the images have to be follow-ups to be seen
+                await reply(ctx, '\u200d', hidden=True)
+            # if webhooks don't work, just send it yourself
+            message = await reply(ctx, **params)
+    if via_webhook:
+        await reply(ctx, '\u200d', hidden=True)
+    if remember:
+        _remember_attachment(key, message)
 
 
 @slash.slash(name="help", description="Get help with using the bot", guild_ids=guild_ids)
 async def slash_help(ctx: SlashContext):
-    await ctx.send("**Runic Babble** converts ASCII text into the constructed writing system Madouji, "
-                   "created by the Cult of 74.\n\n"
-                   "To learn more, visit the official server: https://discord.gg/mg4mCZGFq9", hidden=True)
+    await reply(ctx, "**Runic Babble** converts ASCII text into the constructed writing system Madouji, "
+                     "created by the Cult of 74.\n\n"
+                     "To learn more, visit the official server: https://discord.gg/mg4mCZGFq9", hidden=True)
+
+
+def is_admin(user):
+    """
+    Whether a user is one of the bot admins, whose IDs are listed in `discord.admins` (a list, or comma-separated).
+    """
+    admins = cfg.discord.admins([])
+    if isinstance(admins, str):
+        admins = admins.split(',')
+    return str(user.id) in {str(admin).strip() for admin in admins}
+
+
+@slash.slash(name="stats",
+             description="Show where the bot spends its time (bot admins only)",
+             options=[
+                 create_option(
+                     name="profile",
+                     description="Profile the next requests with cProfile",
+                     option_type=SlashCommandOptionType.INTEGER,
+                     required=False
+                 )
+             ],
+             guild_ids=guild_ids)
+async def slash_stats(ctx: SlashContext, profile: int = None):
+    if not is_admin(ctx.author):
+        await reply(ctx, 'Only the bot admins can see its statistics.', hidden=True)
+        return
+    if profile:
+        metrics.profile(profile)
+
+    text = metrics.report()
+    if service.enabled():
+        try:
+            remote = await service.client().stats()
+            text += '\n\nRender service\n' + metrics.report(remote['metrics'])
+        except (OSError, asyncio.TimeoutError, service.ServiceError) as e:
+            text += f'\n\nThe render service is unavailable ({e!r})'
+    if metrics.profiling():
+        text += f'\n\nProfiling the next {metrics.profiling()} requests'
+    elif metrics.last_profile is not None:
+        text += f'\n\nLast profile: {metrics.last_profile}'
+    # the message limit is 2000 characters
+    await reply(ctx, f'```\n{text[:1980]}\n```', hidden=True)
 
 
 def start():
+    runicbabble.config.watch('config', float(cfg.config.reload_interval(5)))
     try:
         client.run(cfg.discord.bot_token())
     except KeyError:
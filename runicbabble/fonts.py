@@ -0,0 +1,47 @@
+import logging
+
+from PIL import ImageFont
+
+from runicbabble import metrics
+from runicbabble.cache import LRUCache
+from runicbabble.config import cfg
+
+log = logging.getLogger(__name__)
+
+MADOUJI_PATH = 'config/res/fonts/Madouji.ttf'
+
+_fonts = LRUCache(maxsize=int(cfg.render.font_cache_size(32)))
+
+
+def load(path, size, index=0):
+    """
+    Get a font from the process-wide font registry, only opening and parsing the font file on a cache miss.
+    Fonts are keyed by (path, size, index), where the index selects the face (variant) inside a font collection.
+
+    :param path: the path to the font file
+    :param size: the requested font size
+    :param index: which font face to load from the file
+    :return: a (shared) `ImageFont.FreeTypeFont`
+    """
+    def create():
+        log.debug(f'Loading font "{path}" at size {size}')
+        return ImageFont.truetype(path, size, index=index)
+
+    return _fonts.get_or_create((path, size, index), create)
+
+
+def variant(font: ImageFont.FreeTypeFont, size):
+    """
+    Cached equivalent of `font.font_variant(size=size)`.
+    """
+    if not isinstance(font.path, str):
+        # loaded from a file object, there is no stable key for it
+        return font.font_variant(size=size)
+    return load(font.path, size, font.index)
+
+
+def stats():
+    return _fonts.stats()
+
+
+metrics.register('fonts', stats)
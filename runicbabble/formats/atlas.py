@@ -0,0 +1,105 @@
+from PIL import Image, ImageChops, ImageDraw, ImageFont
+
+from runicbabble.cache import LRUCache
+
+# line spacing used by Pillow's multiline text functions
+SPACING = 4
+
+
+class GlyphAtlas:
+    """
+    Holds every glyph of a font at one size pre-rasterized as an 8-bit mask, together with its offset and advance.
+    Text is then composed by blitting the glyph tiles instead of going through FreeType for every character, which
+    gives the same pixels as `ImageDraw.text` for simple scripts like Madouji (no kerning or shaping).
+    """
+
+    def __init__(self, font: ImageFont.FreeTypeFont, charset='', max_glyphs=512):
+        self.font = font
+        self.max_glyphs = max_glyphs
+        self.line_spacing = font.getsize('A')[1] + SPACING
+        self._glyphs = {}
+        for c in charset:
+            self.glyph(c)
+
+    def __len__(self):
+        return len(self._glyphs)
+
+    def glyph(self, c):
+        """
+        :return: a tuple (tile, offset, advance) for the character, where `tile` may be None for blank glyphs
+        """
+        try:
+            return self._glyphs[c]
+        except KeyError:
+            pass
+        glyph = self._rasterize(c)
+        if len(self._glyphs) < self.max_glyphs:
+            self._glyphs[c] = glyph
+        return glyph
+
+    def _rasterize(self, c):
+        mask, offset = self.font.getmask2(c, 'L')
+        advance = self.font.getlength(c)
+        if mask.size[0] == 0 or mask.size[1] == 0:
+            return None, offset, advance
+        tile = Image.new('L', mask.size, 0)
+        ImageDraw.Draw(tile).text((-offset[0], -offset[1]), c, 255, font=self.font)
+        return tile, offset, advance
+
+    def advance(self, c):
+        return self.glyph(c)[2]
+
+    def line_width(self, line):
+        x = 0
+        right = 0
+        for c in line:
+            tile, offset, advance = self.glyph(c)
+            if tile is not None:
+                right = max(right, int(x) + offset[0] + tile.width)
+            x += advance
+        return max(int(x), right)
+
+    def measure(self, text):
+        """
+        Equivalent of `font.getsize_multiline(text)`.
+        """
+        lines = text.split('\n')
+        width = max(self.line_width(line) for line in lines)
+        return width, len(lines) * self.line_spacing - SPACING
+
+    def draw_line(self, mask, xy, line):
+        x, y = xy
+        right = 0
+        for c in line:
+            tile, offset, advance = self.glyph(c)
+            if tile is not None:
+                box = (int(x) + offset[0], y + offset[1])
+                if box[0] < right:
+                    # overlaps the previous glyph: FreeType keeps the brighter pixel
+                    region = mask.crop((box[0], box[1], box[0] + tile.width, box[1] + tile.height))
+                    mask.paste(ImageChops.lighter(region, tile), box)
+                else:
+                    mask.paste(tile, box)
+                right = max(right, box[0] + tile.width)
+            x += advance
+
+    def render(self, text, size=None):
+        """
+        Render (multiline) text into a new 8-bit mask.
+        """
+        mask = Image.new('L', size or self.measure(text), 0)
+        y = 0
+        for line in text.split('\n'):
+            self.draw_line(mask, (0, y), line)
+            y += self.line_spacing
+        return mask
+
+
+_atlases = LRUCache(maxsize=16)
+
+
+def get(font: ImageFont.FreeTypeFont, charset=''):
+    """
+    Get the shared atlas for a font, building it (and pre-rasterizing `charset`) on first use.
+    """
+    return _atlases.get_or_create((font.path, font.size, font.index), lambda: GlyphAtlas(font, charset))
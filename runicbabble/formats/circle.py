@@ -1,7 +1,19 @@
 from PIL import Image, ImageDraw, ImageFont
+import io
+import logging
 import math
 from abc import ABC, abstractmethod
 
+from runicbabble import fonts, metrics
+from runicbabble.cache import LRUCache
+from runicbabble.config import cfg
+from . import encode, vector
+
+log = logging.getLogger(__name__)
+
+# the smallest tiles (in pixels) rings are supersampled in before the supersampling factor is lowered instead
+MIN_TILE = 64
+
 
 class CircleSegment(ABC):
     @property
@@ -17,6 +29,27 @@ class CircleSegment(ABC):
     def render(self, img, draw, circle, radius):
         pass
 
+    def cache_key(self):
+        """
+        A hashable description of everything that influences how this segment looks, or None if its rendered
+        layer should not be cached.
+        """
+        return None
+
+    def render_layer(self, circle, radius):
+        """
+        Render only this segment onto a transparent canvas the size of the whole circle.
+        """
+        layer = Image.new("RGBA", (2*circle.radius, 2*circle.radius), (0, 0, 0, 0))
+        self.render(layer, ImageDraw.Draw(layer), circle, radius)
+        return layer
+
+    def svg(self, svg: vector.SVG, circle, radius):
+        """
+        Add this segment to an SVG document, see `MagicCircle.svg`.
+        """
+        raise NotImplementedError(f'{type(self).__name__} has no vector output')
+
 
 class CenterNgon(CircleSegment):
     def __init__(self, radius, n_sides, rotation=0.0, fill=None, outline=None, width=1):
@@ -35,41 +68,200 @@ class CenterNgon(CircleSegment):
     def margin(self):
         return 0
 
+    def cache_key(self):
+        return 'ngon', self.radius, self.n_sides, self.rotation, self.fill, self.outline, self.width
+
     def render(self, img, draw, circle, radius):
         draw_stellated_regular_polygon(draw, (circle.center, self.radius), self.n_sides,
                                        self.rotation, self.fill, self.outline, self.width)
 
+    def svg(self, svg, circle, radius):
+        edges = stellated_regular_polygon((circle.center, self.radius), self.n_sides, self.rotation)
+        cx, cy = circle.center
+        if self.fill is not None:
+            svg.path(''.join(f'M{vector.point(a)}L{vector.point(b)}L{vector.point((cx, cy))}Z' for a, b in edges),
+                     fill=self.fill)
+        if self.outline is not None:
+            svg.path(''.join(f'M{vector.point(a)}L{vector.point(b)}' for a, b in edges),
+                     outline=self.outline, width=self.width)
+
 
 class TextRing(CircleSegment):
-    def __init__(self, text, font, color, rotation=0.0, angle=None, upscale=4):
+    """
+    Text written around a ring. The 'rotate' backend pastes every character as a rotated image onto supersampled
+    tiles, as large as `render.memory_budget` allows, and only where the ring has glyphs; the 'polar' backend writes
+    the text onto a straight strip once and warps that onto the ring (needs NumPy); the 'vector' backend fills the
+    glyph outlines from the font's `.sfd` file at their final position and angle, and only supersamples each glyph's
+    bounding box.
+    """
+
+    def __init__(self, text, font, color, rotation=0.0, angle=None, upscale=4, backend='rotate'):
         self.text = text
         self.font = font
         self.color = color
         self.rotation = rotation
         self.angle = angle or 360 / len(text)
         self.upscale = upscale
+        self.backend = backend
 
     @property
     def radius(self):
         return self.font.size
 
+    def cache_key(self):
+        return ('text', self.text, self.font.path, self.font.size, self.font.index, self.color, self.rotation,
+                self.angle, self.upscale, self.backend)
+
     def render(self, img, draw, circle, radius):
-        angle_rad = self.angle / 360 * 2 * math.pi
+        ring = self._render_ring(img.size, circle, radius)
+        img.paste(ring, mask=ring)
 
-        bigger_size = (img.size[0] * self.upscale, img.size[1] * self.upscale)
-        bigger_font = self.font.font_variant(size=self.font.size * self.upscale)
+    def render_layer(self, circle, radius):
+        return self._render_ring((2*circle.radius, 2*circle.radius), circle, radius)
 
-        ucx, ucy = circle.center[0] * self.upscale, circle.center[1] * self.upscale
-        rad = radius * self.upscale + bigger_font.size / 2
+    def svg(self, svg, circle, radius):
+        outlines = vector.outlines(self.font.path)
+        svg.glyphs(outlines, self._placed(outlines, circle.center, radius), self.color)
 
-        img2 = Image.new("RGBA", bigger_size, (0, 0, 0, 0))
+    def _placed(self, outlines, center, radius):
+        """
+        The position of every glyph as (character, matrix), the same as the 'rotate' backend draws them.
+        """
+        size = self.font.size
+        angle_rad = self.angle / 360 * 2 * math.pi
+        rad = radius + size / 2
+        height = outlines.em * outlines.scale(size)
+        # the raster backends rotate counterclockwise, the matrices clockwise
+        ring = vector.rotate(-(self.rotation + 90), center)
+        for i, c in enumerate(self.text):
+            if not outlines.glyph(c).contours:
+                continue
+            origin = (center[0] + rad * math.cos(angle_rad * i), center[1] + rad * math.sin(angle_rad * i))
+            glyph = vector.multiply(vector.rotate(90 + self.angle * i),
+                                    vector.translate(-outlines.advance(c, size) / 2, -height / 2))
+            matrix = vector.multiply(vector.multiply(ring, vector.translate(*origin)), glyph)
+            yield c, vector.multiply(matrix, (outlines.scale(size), 0, 0, outlines.scale(size), 0, 0))
+
+    def _render_ring(self, size, circle, radius):
+        if self.backend == 'polar':
+            return self._render_polar(size, circle, radius)
+        if self.backend == 'vector':
+            return self._render_vector(size, circle, radius)
+
+        left, top, right, bottom = self._supersample_box(size, circle, radius)
+        ring = Image.new("RGBA", size, (0, 0, 0, 0))
+        # the ring and the cropped copy `MagicCircle.layer` makes of it
+        upscale, tile = self._fit_tiles(size[0] * size[1] * 4 * 2, max(right - left, bottom - top))
+        bigger_font = fonts.variant(self.font, self.font.size * upscale)
+
+        # every glyph is rotated to its final angle, in supersampled coordinates of the whole canvas
+        angle_rad = self.angle / 360 * 2 * math.pi
+        offset_rad = -(self.rotation + 90) / 360 * 2 * math.pi
+        rad = radius * upscale + bigger_font.size / 2
+        ucx, ucy = circle.center[0] * upscale, circle.center[1] * upscale
+        glyphs = []
         for i, c in enumerate(self.text):
-            angled = angled_text(c, fill=self.color, font=bigger_font, angle=-90 - self.angle * i)
-            text_origin = (ucx + rad * math.cos(angle_rad * i), ucy + rad * math.sin(angle_rad * i))
-            img2.paste(angled, box=(int(text_origin[0] - angled.width / 2), int(text_origin[1] - angled.height / 2)))
+            angled = rotated_glyph(c, fill=self.color, font=bigger_font, angle=self.rotation - self.angle * i)
+            x = ucx + rad * math.cos(angle_rad * i + offset_rad)
+            y = ucy + rad * math.sin(angle_rad * i + offset_rad)
+            box = (int(x - angled.width / 2), int(y - angled.height / 2))
+            glyphs.append((angled, box, (box[0] + angled.width, box[1] + angled.height)))
+
+        # only tiles that glyphs reach are supersampled, which leaves out the inside of the ring. The LANCZOS filter
+        # reads 3 pixels beyond each output pixel, so tiles are drawn with that margin to avoid seams
+        margin = 3 * upscale
+        for y in range(top, bottom, tile):
+            for x in range(left, right, tile):
+                w, h = min(tile, right - x), min(tile, bottom - y)
+                x0, y0 = x * upscale - margin, y * upscale - margin
+                x1, y1 = (x + w) * upscale + margin, (y + h) * upscale + margin
+                inside = [(angled, box) for angled, box, end in glyphs
+                          if box[0] < x1 and end[0] > x0 and box[1] < y1 and end[1] > y0]
+                if not inside:
+                    continue
+                canvas = Image.new("RGBA", (x1 - x0, y1 - y0), (0, 0, 0, 0))
+                for angled, box in inside:
+                    canvas.paste(angled, (box[0] - x0, box[1] - y0))
+                ring.paste(canvas.resize((w, h), resample=Image.LANCZOS,
+                                         box=(margin, margin, margin + w * upscale, margin + h * upscale)), (x, y))
+        return ring
+
+    def _supersample_box(self, size, circle, radius):
+        # rotated glyphs reach at most half their diagonal beyond the middle of the ring
+        reach = radius + self.font.size / 2 + max(math.hypot(*self.font.getsize(c)) for c in set(self.text)) / 2 + 2
+        cx, cy = circle.center
+        return (max(int(cx - reach), 0), max(int(cy - reach), 0),
+                min(int(math.ceil(cx + reach)), size[0]), min(int(math.ceil(cy + reach)), size[1]))
+
+    def _fit_tiles(self, reserved, largest):
+        """
+        Choose the supersampling factor and the size of the square tiles the rotate backend draws, so that a tile's
+        buffers fit into `render.memory_budget` bytes besides the `reserved` ones. Tiles are never larger than
+        `largest` pixels, and the factor is only lowered if tiles would get smaller than `MIN_TILE` pixels. The
+        rotated glyphs are not included, the sprite cache has its own limit.
+
+        :return: a tuple (upscale, tile size)
+        """
+        budget = int(cfg.render.memory_budget(256 * 1024 * 1024)) - reserved
+
+        def tile_bytes(tile, upscale):
+            # the supersampled canvas and its premultiplied copy, the result of the horizontal pass of the resize,
+            # and the tile before and after converting it back
+            side = tile * upscale + 6 * upscale
+            return 4 * (2 * side * side + tile * side + 2 * tile * tile)
+
+        for upscale in range(self.upscale, 0, -1):
+            tile = largest
+            while tile > MIN_TILE and tile_bytes(tile, upscale) > budget:
+                tile = max(MIN_TILE, int(tile * 0.9))
+            if tile_bytes(tile, upscale) <= budget or upscale == 1:
+                break
+        if upscale != self.upscale:
+            log.debug(f'Supersampling ring at {upscale}x instead of {self.upscale}x to stay within the memory budget')
+        return upscale, max(tile, 1)
+
+    def _fit_upscale(self, area, bytes_per_pixel):
+        """
+        Lower the supersampling factor until the buffers for `area` pixels fit into `render.memory_budget` bytes.
+        """
+        budget = int(cfg.render.memory_budget(256 * 1024 * 1024))
+        upscale = self.upscale
+        while upscale > 1 and area * upscale ** 2 * bytes_per_pixel > budget:
+            upscale -= 1
+        if upscale != self.upscale:
+            log.debug(f'Supersampling ring at {upscale}x instead of {self.upscale}x to stay within the memory budget')
+        return upscale
+
+    def _render_vector(self, size, circle, radius):
+        left, top, right, bottom = self._supersample_box(size, circle, radius)
+        outlines = vector.outlines(self.font.path)
+        center = (circle.center[0] - left, circle.center[1] - top)
+        mask = vector.rasterize(Image.new('L', (right - left, bottom - top), 0), outlines,
+                                self._placed(outlines, center, radius), supersample=self.upscale)
+        ring = Image.new("RGBA", size, (0, 0, 0, 0))
+        ring.paste(encode.colorize(mask, self.color), (left, top))
+        return ring
+
+    def _render_polar(self, size, circle, radius):
+        from . import polar
+
+        # one strip pixel per (supersampled) pixel of arc length along the middle of the ring; the strip is also
+        # needed as floats, which takes 5 bytes per pixel in total
+        circumference = 2 * math.pi * (radius + self.font.size / 2)
+        upscale = self._fit_upscale(circumference * self.font.size, 5)
+        bigger_font = fonts.variant(self.font, self.font.size * upscale)
+        strip_width = max(int(round(circumference * upscale)), 1)
+        strip = Image.new('L', (strip_width, bigger_font.size), 0)
+        draw = ImageDraw.Draw(strip)
+        for i, c in enumerate(self.text):
+            w, h = bigger_font.getsize(c)
+            x = self.angle * i / 360 * strip_width - w / 2
+            for shift in (-strip_width, 0, strip_width):
+                if x + shift < strip_width and x + shift + w > 0:
+                    draw.text((x + shift, (bigger_font.size - h) / 2), c, 255, font=bigger_font)
 
-        img2 = img2.rotate(self.rotation + 90, center=(ucx, ucy)).resize(img.size, resample=Image.LANCZOS)
-        img.paste(img2, mask=img2)
+        return polar.warp_ring(strip, size, circle.center, radius, radius + self.font.size,
+                               rotation=-self.rotation, color=self.color)
 
 
 class RingSeparator(CircleSegment):
@@ -99,21 +291,35 @@ class RingSeparator(CircleSegment):
     def radius(self):
         return self._radius
 
+    def cache_key(self):
+        return 'separator', tuple(self._widths), self.color
+
     def render(self, img, draw, circle, radius):
         r = radius
         for width in self._widths:
             draw_circle(draw, (circle.center, r + width), width=width, outline=self.color)
             r += width + 4
 
+    def svg(self, svg, circle, radius):
+        r = radius
+        for width in self._widths:
+            # the stroke is centered on the circle, the raster ring lies inside its bounding circle
+            svg.circle(circle.center, r + width / 2, outline=self.color, width=width)
+            r += width + 4
+
 
 class MagicCircle:
     def __init__(self, segments=None):
         self.segments = segments or []
         self.radius, self.center = None, None
 
-    def render(self):
+    def _measure(self):
         self.radius = sum(seg.radius+seg.margin for seg in self.segments)
         self.center = (self.radius, self.radius)
+
+    @metrics.timed('circle_render')
+    def render(self):
+        self._measure()
         img = Image.new("RGBA", (2*self.radius, 2*self.radius), (0, 0, 0, 0))
 
         draw = ImageDraw.Draw(img)
@@ -121,10 +327,56 @@ class MagicCircle:
 
         r = 0
         for seg in self.segments:
-            seg.render(img, draw, self, r)
+            layer, box = self.layer(seg, r)
+            if layer is not None:
+                img.paste(layer, box, mask=layer)
             r += seg.radius+seg.margin
         return img
 
+    def svg(self):
+        """
+        Draw the circle as vector graphics, which takes far less time and space than rendering it for large circles.
+
+        :return: a `vector.SVG` document, `str()` gives its source
+        """
+        self._measure()
+        svg = vector.SVG(2*self.radius, 2*self.radius)
+        svg.circle(self.center, self.radius, fill=(0, 0, 0))
+
+        r = 0
+        for seg in self.segments:
+            seg.svg(svg, self, r)
+            r += seg.radius+seg.margin
+        return svg
+
+    def layer(self, seg, radius):
+        """
+        Get the rendered layer of a segment at the given radius offset, cropped to its visible content. Layers are
+        cached by the segment's parameters, so only segments that changed since the last render are redrawn.
+
+        :return: a tuple (layer, box) of the cropped layer and where to paste it, or (None, None) if it is empty
+        """
+        def render():
+            with metrics.timed('circle_layer'):
+                return _crop_layer(seg.render_layer(self, radius))
+
+        key = seg.cache_key()
+        if key is None:
+            return render()
+        return layers.get_or_create((key, radius, self.radius), render)
+
+
+# cropped segment layers, weighed by their size in bytes
+layers = LRUCache(maxsize=None, weigh=lambda entry: entry[0].width * entry[0].height * 4 if entry[0] else 0,
+                  maxweight=int(cfg.render.layer_cache_bytes(128 * 1024 * 1024)))
+
+
+def _crop_layer(layer):
+    box = layer.getbbox()
+    if box is None:
+        return None, None
+    return layer.crop(box), box[:2]
+
 
 def _extract_circle(circle):
     if len(circle) == 3:
@@ -135,7 +387,10 @@ def _extract_circle(circle):
         raise ValueError
 
 
-def draw_stellated_regular_polygon(draw, bounding_circle, n_sides, rotation=0.0, fill=None, outline=None, width=1):
+def stellated_regular_polygon(bounding_circle, n_sides, rotation=0.0):
+    """
+    :return: the edges of the star polygon as a list of (start, end) points
+    """
     step = n_sides / 2 - (1 if n_sides % 2 == 0 else 1 / 2)
 
     cx, cy, r = _extract_circle(bounding_circle)
@@ -143,16 +398,19 @@ def draw_stellated_regular_polygon(draw, bounding_circle, n_sides, rotation=0.0,
     def point_on_circle(k):
         return r*math.cos(k/n_sides*2*math.pi+rotation)+cx, r*math.sin(k/n_sides*2*math.pi+rotation)+cy
 
+    return [(point_on_circle(i), point_on_circle(i+step)) for i in range(n_sides)]
+
+
+def draw_stellated_regular_polygon(draw, bounding_circle, n_sides, rotation=0.0, fill=None, outline=None, width=1):
+    cx, cy, _ = _extract_circle(bounding_circle)
+    edges = stellated_regular_polygon(bounding_circle, n_sides, rotation)
+
     if fill is not None:
-        for i in range(n_sides):
-            curr = point_on_circle(i)
-            next = point_on_circle(i+step)
+        for curr, next in edges:
             draw.polygon([curr, next, (cx, cy)], fill=fill, outline=None)
 
     if outline is not None:
-        for i in range(n_sides):
-            curr = point_on_circle(i)
-            next = point_on_circle(i+step)
+        for curr, next in edges:
             draw.line([curr, next], fill=outline, width=width)
 
 
@@ -164,13 +422,32 @@ def angled_text(text, fill=None, font=None, angle=0.0):
     return im.rotate(angle, expand=True)
 
 
+# rotated glyphs are weighed by their size in bytes
+sprites = LRUCache(maxsize=None, weigh=lambda im: im.width * im.height * 4,
+                   maxweight=int(cfg.render.sprite_cache_bytes(64 * 1024 * 1024)))
+
+metrics.register('circle_layers', layers.stats)
+metrics.register('circle_sprites', sprites.stats)
+
+
+def rotated_glyph(char, fill=None, font=None, angle=0.0):
+    """
+    Cached version of `angled_text` for a single character. The angle is rounded to multiples of
+    `render.sprite_angle_step` degrees, so that glyphs at almost the same angle share a sprite.
+    """
+    step = float(cfg.render.sprite_angle_step(0.5))
+    angle = round(angle % 360 / step) * step
+    key = (char, font.path, font.size, font.index, angle, fill)
+    return sprites.get_or_create(key, lambda: angled_text(char, fill=fill, font=font, angle=angle))
+
+
 def circle_text(img, text, base_circle, rotation, font: ImageFont.FreeTypeFont, color, angle=None, upscale=4):
     if angle is None:
         angle = 360 / len(text)
     angle_rad = angle/360*2*math.pi
 
     bigger_size = (img.size[0]*upscale, img.size[1]*upscale)
-    bigger_font = font.font_variant(size=font.size*upscale)
+    bigger_font = fonts.variant(font, font.size*upscale)
 
     cx, cy, r = _extract_circle(base_circle)
     ucx, ucy = cx*upscale, cy*upscale
@@ -178,7 +455,7 @@ def circle_text(img, text, base_circle, rotation, font: ImageFont.FreeTypeFont,
 
     img2 = Image.new("RGBA", bigger_size, (0, 0, 0, 0))
     for i, c in enumerate(text):
-        angled = angled_text(c, fill=color, font=bigger_font, angle=-90-angle*i)
+        angled = rotated_glyph(c, fill=color, font=bigger_font, angle=-90-angle*i)
         text_origin = (ucx + rad*math.cos(angle_rad*i), ucy + rad*math.sin(angle_rad*i))
         img2.paste(angled, box=(int(text_origin[0]-angled.width/2), int(text_origin[1]-angled.height/2)))
 
@@ -210,22 +487,67 @@ def draw_circle_separator(draw, base_circle, style, color):
     return r
 
 
-def main():
+def example_circle(font_path=fonts.MADOUJI_PATH):
     msg1 = '#hey dok'
     color = (100, 200, 255)
-    font = ImageFont.truetype("../../config/res/fonts/Madouji", 60)
-    
-    mc = MagicCircle([
+    font = fonts.load(font_path, 60)
+
+    return MagicCircle([
         CenterNgon(380, len(msg1), rotation=-math.pi/2, outline=color, width=6),
         RingSeparator('m', color),
-        TextRing(msg1, font.font_variant(size=120), color),
+        TextRing(msg1, fonts.variant(font, 120), color),
         RingSeparator('ss', color),
-        TextRing('ayv ymprUvd may progrem, so naó yt dZenereýtz VIz swrklz Iseli. ', font.font_variant(size=30), color),
+        TextRing('ayv ymprUvd may progrem, so naó yt dZenereýtz VIz swrklz Iseli. ', fonts.variant(font, 30), color),
         RingSeparator('m', color),
-        TextRing('Vetz pryti nyfti ay úud sey. ', font.font_variant(size=60), color),
+        TextRing('Vetz pryti nyfti ay úud sey. ', fonts.variant(font, 60), color),
         RingSeparator('sl', color)
     ])
-    
+
+
+def _color(value):
+    # JSON has no tuples, but colors are part of the (hashable) layer cache keys
+    return None if value is None else tuple(value)
+
+
+def from_spec(spec):
+    """
+    Build a magic circle from a JSON-compatible description, a list of segments from the inside out:
+
+    - `{"type": "ngon", "radius": 380, "sides": 8, "rotation": 0.0, "fill": null, "outline": [r, g, b], "width": 1}`
+    - `{"type": "text", "text": "...", "size": 60, "color": [r, g, b], "rotation": 0.0, "font": "path/to/font.ttf",
+      "backend": "rotate"}`
+    - `{"type": "separator", "style": "m", "color": [r, g, b]}`
+    """
+    segments = []
+    for seg in spec:
+        kind = seg['type']
+        if kind == 'ngon':
+            segments.append(CenterNgon(int(seg['radius']), int(seg['sides']), float(seg.get('rotation', 0.0)),
+                                       _color(seg.get('fill')), _color(seg.get('outline')), int(seg.get('width', 1))))
+        elif kind == 'text':
+            font = fonts.load(seg.get('font', fonts.MADOUJI_PATH), int(seg['size']))
+            segments.append(TextRing(seg['text'], font, _color(seg['color']), float(seg.get('rotation', 0.0)),
+                                     backend=seg.get('backend', 'rotate')))
+        elif kind == 'separator':
+            segments.append(RingSeparator(seg['style'], _color(seg['color'])))
+        else:
+            raise ValueError(f'Unknown circle segment type "{kind}"')
+    return MagicCircle(segments)
+
+
+def render_spec(spec, format='png'):
+    """
+    Render a magic circle described by `from_spec` as a PNG image, or as an SVG document if `format` is 'svg'.
+    """
+    if format == 'svg':
+        return from_spec(spec).svg().encode()
+    with io.BytesIO() as image_binary:
+        from_spec(spec).render().save(image_binary, 'PNG')
+        return image_binary.getvalue()
+
+
+def main():
+    mc = example_circle()
     img = mc.render()
     img.show()
     img.save('output.png')
@@ -0,0 +1,66 @@
+import io
+
+from PIL import Image
+
+from runicbabble.config import cfg
+
+# 'palette': a PNG whose 256 palette entries are the text color at every opacity, so the mask is stored as is
+# 'la': a grey + alpha PNG, only exact for grey colors like the default white
+# 'rgba': a full color PNG, like images used to be encoded
+# 'webp': a lossless WebP image
+formats = ('palette', 'la', 'rgba', 'webp')
+
+
+def colorize(mask: Image.Image, color=(255, 255, 255)):
+    """
+    Turn an 8-bit coverage mask into an RGBA image of the given color, with the mask as its alpha channel.
+    """
+    img = Image.new('RGBA', mask.size, tuple(color[:3]) + (0,))
+    img.putalpha(mask)
+    return img
+
+
+def encode(mask: Image.Image, color=(255, 255, 255), format=None, compress_level=None):
+    """
+    Encode a text mask as an image of the given color on a transparent background.
+
+    :param mask: an 8-bit coverage mask
+    :param format: one of `formats`, defaults to the `render.format` setting ('palette')
+    :param compress_level: the zlib level (0-9) for PNGs, or the effort (0-6) for WebP; defaults to the
+        `render.compress_level` setting, or the encoder's own default
+    :return: the encoded image
+    """
+    format = format or cfg.render.format('palette')
+    if compress_level is None:
+        compress_level = cfg.render.compress_level(None)
+
+    options = {}
+    if format == 'webp':
+        img = colorize(mask, color)
+        options.update(lossless=True)
+        if compress_level is not None:
+            options.update(method=int(compress_level))
+    else:
+        if format == 'palette':
+            img = mask.copy()
+            img.putpalette(bytes(color[:3]) * 256)
+            options.update(transparency=bytes(range(256)))
+        elif format == 'la':
+            img = Image.merge('LA', (Image.new('L', mask.size, color[0]), mask))
+        elif format == 'rgba':
+            img = colorize(mask, color)
+        else:
+            raise ValueError(f'Unknown image format "{format}", expected one of {", ".join(formats)}')
+        if compress_level is not None:
+            options.update(compress_level=int(compress_level))
+
+    with io.BytesIO() as image_binary:
+        img.save(image_binary, 'WEBP' if format == 'webp' else 'PNG', **options)
+        return image_binary.getvalue()
+
+
+def extension(data: bytes):
+    """
+    The file extension for encoded image data.
+    """
+    return 'webp' if data[:4] == b'RIFF' and data[8:12] == b'WEBP' else 'png'
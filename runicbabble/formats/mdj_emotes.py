@@ -1,44 +1,99 @@
 import discord
 
 import runicbabble.discord
-from discord.utils import get as discord_get
+import runicbabble.text
 import re
 
 
 def mdj_format(message):
-    message = message.replace('a\'', 'á').replace('A\'', 'á') \
-        .replace('e\'', 'é').replace('E\'', 'é') \
-        .replace('i\'', 'í').replace('I\'', 'í') \
-        .replace('o\'', 'ó').replace('O\'', 'ó') \
-        .replace('u\'', 'ú').replace('U\'', 'ú') \
-        .replace('y\'', 'ý').replace('Y\'', 'ý') \
-        .replace('w\'', '\xb5').replace('W\'', '\xb5')
-    return message
+    return runicbabble.text.transliterate(message)
 
 
+standard_characters = 'uoaeyiwUOAEYIWpbtdkgmnqjrlRfFsSxhvVzZ'
+special_mappings = {'ú': 'u_', 'ó': 'o_','á': 'a_','é':'e_','ý': 'y_','í': 'i_','\xb5': 'w_',
+                    ' ': 'space', '.': 'dot', ',': 'comma', '?': 'question', '#': 'direction'}
+# emote name -> the character it stands for
+emote_names = {**{f'mdj_{c}': c for c in standard_characters},
+               **{f'mdj_{v}': c for c, v in special_mappings.items()}}
+
 emotes = dict()
+guild_emotes = dict()
+_tables = dict()
+
+
+def index_emojis(emojis):
+    """
+    Find the Madouji emotes among a list of emojis, in a single pass.
+
+    :return: a dict from characters to the emote strings that display them
+    """
+    result = {}
+    for emoji in emojis:
+        c = emote_names.get(emoji.name)
+        if c is not None and c not in result:
+            result[c] = str(emoji)
+    return result
+
+
+def _rebuild():
+    # emotes of any guild can be used everywhere, the first guild to provide one wins
+    emotes.clear()
+    for found in guild_emotes.values():
+        for c, emote in found.items():
+            emotes.setdefault(c, emote)
+    _tables.clear()
+
+
+def update_guild(guild: discord.Guild, emojis=None):
+    """
+    Re-index the emotes of a single guild, e.g. after its emojis were changed.
+    """
+    guild_emotes[guild.id] = index_emojis(guild.emojis if emojis is None else emojis)
+    _rebuild()
+
+
+def remove_guild(guild: discord.Guild):
+    if guild_emotes.pop(guild.id, None) is not None:
+        _rebuild()
 
 
 async def init_emotes():
-    standard_characters = 'uoaeyiwUOAEYIWpbtdkgmnqjrlRfFsSxhvVzZ'
-    special_mappings = {'ú': 'u_', 'ó': 'o_','á': 'a_','é':'e_','ý': 'y_','í': 'i_','\xb5': 'w_',
-                        ' ': 'space', '.': 'dot', ',': 'comma', '?': 'question', '#': 'direction'}
-    for c in standard_characters:
-        emotes[c] = str(discord_get(runicbabble.discord.client.emojis, name=f'mdj_{c}'))
-    for c, v in special_mappings.items():
-        emotes[c] = str(discord_get(runicbabble.discord.client.emojis, name=f'mdj_{v}'))
+    guild_emotes.clear()
+    for guild in runicbabble.discord.client.guilds:
+        guild_emotes[guild.id] = index_emojis(guild.emojis)
+    _rebuild()
+    for guild_id in guild_emotes:
+        translation_table(guild_id)
 
 
-def mdj_emote_format(message):
-    return ''.join(emotes[c] if c in emotes else c for c in message)
+def translation_table(guild_id=None):
+    """
+    The `str.translate` table replacing characters with emotes, preferring the emotes of the given guild.
+    """
+    try:
+        return _tables[guild_id]
+    except KeyError:
+        table = str.maketrans({**emotes, **guild_emotes.get(guild_id, {})})
+        _tables[guild_id] = table
+        return table
 
 
-def render(message: str):
-    def handle_mdj(m: re.Match):
-        return mdj_emote_format(mdj_format(m.group(1)))
+def mdj_emote_format(message, guild_id=None):
+    return message.translate(translation_table(guild_id))
+
+
+_pattern = re.compile(r'(?<!\\)`mdj\s([^`]*)`', re.DOTALL)
 
-    pattern = r'(?<!\\)`mdj\s([^`]*)`'
-    if re.search(pattern, message, re.DOTALL) is None:
+
+def render(message: str, guild_id=None):
+    # almost no message contains Madouji, so rule those out before running the regex
+    if '`mdj' not in message:
         return None
 
-    return {'content': re.sub(pattern, handle_mdj, message, flags=re.DOTALL)}
+    def handle_mdj(m: re.Match):
+        return mdj_emote_format(mdj_format(m.group(1)), guild_id)
+
+    content, count = _pattern.subn(handle_mdj, message)
+    if count == 0:
+        return None
+    return {'content': content}
@@ -1,64 +1,240 @@
+import hashlib
 import io
+import os
 
 import discord
-from PIL import Image, ImageDraw, ImageFont
-from .mdj_emotes import mdj_format
+import logging
+from PIL import Image, ImageDraw
+
+from runicbabble import fonts, metrics, service, text, workers
+from runicbabble.cache import LRUCache, SingleFlight
+from runicbabble.config import cfg
+from . import atlas, encode, vector
+from .mdj_emotes import mdj_format, standard_characters, special_mappings
+
+log = logging.getLogger(__name__)
 
 
 def text_wrap(message, line_length=8, force=False):
-    if force:
-        res = ''
-        cursor = 0
-        while cursor < len(message):
-            skip = cursor + line_length
-            find = message.find('\n', cursor, skip)
-            if find != -1:
-                skip = find + 1
-            res += message[cursor:skip]
-            cursor = skip
-            if find == -1 and cursor < len(message) - 1:
-                res += '\n'
-        message = res
-    else:
-        # TODO: implement clever word wrapping
-        res = ''
-        linestart = 0
-        split1 = 0
-        cursor = 0
-        while cursor < len(message):
-            if message[cursor] == ' ' or message[cursor] == '\n':
-                if cursor - linestart >= line_length:
-                    res += '\n'
-                    linestart = split1
-                res += message[split1:cursor + 1]
-                split1 = cursor + 1
-                if message[cursor] == '\n':
-                    linestart = split1
-            cursor += 1
-        if cursor - linestart >= line_length:
-            res += '\n'
-        res += message[split1:cursor]
-        message = res
-
-    return message
+    return text.wrap_text(message, 'force' if force else 'flow', line_length)
+
+
+charset = standard_characters + ''.join(special_mappings)
+
+# a render is a tuple of encoded tiles, see `render_tiles`
+_renders = LRUCache(maxsize=None, weigh=lambda tiles: sum(map(len, tiles)),
+                    maxweight=int(cfg.render.cache_bytes(32 * 1024 * 1024)))
+_inflight = SingleFlight()
+
+
+def render_key(message: str, fontsize: int, wrap: str = 'none', line_length: int = 8):
+    """
+    The cache key for a render: two renders with the same key produce the same image.
+    """
+    if wrap == 'none':
+        line_length = None
+    with metrics.timed('transliterate'):
+        return mdj_format(message), fontsize, wrap, line_length
+
+
+def file_name(key, format=None):
+    """
+    The file name a render is stored under in the `render.prerendered` directory, see `runicbabble.render`.
+    """
+    format = format or cfg.render.format('palette')
+    digest = hashlib.sha256(repr((key, format)).encode()).hexdigest()
+    return f'{digest}.{extension(format)}'
+
+
+def extension(format):
+    """
+    The file extension for an image format: one of `encode.formats`, or 'svg'.
+    """
+    return format if format in ('webp', 'svg') else 'png'
+
+
+def render_png(message: str, fontsize: int, wrap: str = 'none', line_length: int = 8, backend: str = None,
+               format: str = None):
+    """
+    Render a message as an image, encoded as configured by the `render.format` and `render.compress_level`
+    settings (see `runicbabble.formats.encode`).
+
+    :param backend: 'atlas' to compose pre-rasterized glyphs, 'freetype' to draw the text with FreeType directly;
+        both produce the same pixels. Defaults to the `render.backend` setting.
+    :param format: the image format, defaults to the `render.format` setting
+    :return: the encoded image
+    """
+    return encode.encode(_render_mask(*render_key(message, fontsize, wrap, line_length), backend=backend),
+                         format=format)
+
+
+def render_svg(message: str, fontsize: int, wrap: str = 'none', line_length: int = 8, color=(255, 255, 255)):
+    """
+    Render a message as an SVG document, laid out like `render_png` but drawn from the glyph outlines (see
+    `runicbabble.formats.vector`), so it can be scaled to any size.
+
+    :return: the SVG source, encoded as UTF-8
+    """
+    outlines = vector.outlines(fonts.MADOUJI_PATH)
+    msg, fontsize, wrap, line_length = render_key(message, fontsize, wrap, line_length)
+    msg = ''.join(_wrap(msg, wrap, line_length, fontsize, lambda c: outlines.advance(c, fontsize)))
+    svg = vector.SVG(*outlines.measure(msg, fontsize))
+    svg.glyphs(outlines, outlines.layout(msg, fontsize), color)
+    return svg.encode()
+
+
+def render_tiles(msg: str, fontsize: int, wrap: str, line_length: int, backend: str = None, format: str = None):
+    """
+    Render an already formatted message (see `render_key`) as a series of images of at most `render.tile_height`
+    pixels (2048 by default), from top to bottom. The text is wrapped and rasterized a tile at a time, and every
+    tile is encoded as soon as it is complete, so memory use does not grow with the length of the message.
+
+    :return: a generator of encoded images
+    """
+    with metrics.timed('font_load'):
+        font = fonts.load(fonts.MADOUJI_PATH, fontsize)
+        glyphs = atlas.get(font, charset)
+    # the tiles are spaced like lines are, so stacking them gives the same picture as one big image
+    rows = max(1, (int(cfg.render.tile_height(2048)) + atlas.SPACING) // glyphs.line_spacing)
+    tile = []
+    tiles = 0
+    for line in metrics.timed_iter('wrap', text.lines(_wrap(msg, wrap, line_length, fontsize, glyphs.advance))):
+        tile.append(line)
+        if len(tile) == rows:
+            yield _render_tile(tile, font, glyphs, backend, format)
+            tile = []
+            tiles += 1
+    # wrapping can leave empty lines at the end, which would only add a blank tile
+    if tile and (tiles == 0 or any(line.strip() for line in tile)):
+        yield _render_tile(tile, font, glyphs, backend, format)
+
+
+def _render_tile(lines, font, glyphs, backend, format):
+    with metrics.timed('rasterize'):
+        mask = _rasterize('\n'.join(lines), font, glyphs, backend)
+    with metrics.timed('encode'):
+        return encode.encode(mask, format=format)
+
+
+def _render_mask(msg: str, fontsize: int, wrap: str, line_length: int, backend: str = None):
+    font = fonts.load(fonts.MADOUJI_PATH, fontsize)
+    glyphs = atlas.get(font, charset)
+    return _rasterize(''.join(_wrap(msg, wrap, line_length, fontsize, glyphs.advance)), font, glyphs, backend)
+
+
+def _wrap(msg, wrap, line_length, fontsize, advance):
+    if wrap == 'optimal':
+        # break by pixel width, using the glyph advances; the line length is given in em
+        return text.wrap(msg, wrap, line_length * fontsize, advance=advance)
+    return text.wrap(msg, wrap, line_length)
+
+
+def _rasterize(msg, font, glyphs, backend=None):
+    # the text is rasterized as 8-bit coverage only, it is colored when encoding. Empty lines measure 0 pixels wide,
+    # and images can't be encoded without pixels
+    width, height = glyphs.measure(msg)
+    size = (max(1, width), max(1, height))
+    if (backend or cfg.render.backend('atlas')) == 'atlas':
+        return glyphs.render(msg, size)
+
+    mask = Image.new('L', size, 0)
+    ImageDraw.Draw(mask).text((0, 0), msg, 255, font=font)
+    return mask
+
+
+def _as_pages(tiles):
+    """
+    Split tiles into the messages they have to be sent in, as parameters for `send`. Each message holds at most
+    `discord.max_files` attachments (10) of at most `discord.upload_limit` bytes (8MiB) in total.
+    """
+    # discord.File objects are consumed when sent, so every caller gets fresh ones
+    files = [discord.File(fp=io.BytesIO(png), filename=f'mdj-{i}.{encode.extension(png)}' if len(tiles) > 1
+                          else f'mdj.{encode.extension(png)}')
+             for i, png in enumerate(tiles, 1)]
+    if len(files) == 1:
+        return [{'file': files[0]}]
+
+    max_files = int(cfg.discord.max_files(10))
+    limit = int(cfg.discord.upload_limit(8 * 1024 * 1024))
+    pages, page, size = [], [], 0
+    for f, png in zip(files, tiles):
+        if page and (len(page) == max_files or size + len(png) > limit):
+            pages.append({'files': page})
+            page, size = [], 0
+        page.append(f)
+        size += len(png)
+    pages.append({'files': page})
+    return pages
 
 
 def render(message: str, fontsize: int, wrap: str = 'none', line_length: int = 8):
-    path = 'config/res/fonts/Madouji.ttf'
-    msg = mdj_format(message)
-    if wrap != 'none':
-        msg = text_wrap(msg, line_length=line_length, force=(wrap == 'force'))
+    """
+    Render a message into tiles of bounded height.
+
+    :return: a list of parameter dicts for `send`, one per message the tiles have to be spread over
+    """
+    return _as_pages(tuple(render_tiles(*render_key(message, fontsize, wrap, line_length))))
+
+
+async def render_cached(message: str, fontsize: int, wrap: str = 'none', line_length: int = 8):
+    """
+    Like `render`, but reuses the encoded images of earlier identical renders, and lets concurrent identical
+    requests share a single render. Rendering happens in the worker pool, so the event loop is not blocked. If
+    `render.service.socket` is set, the render service does all of this instead.
+
+    :raises runicbabble.workers.Saturated: if the worker pool can not accept any more jobs
+    :raises asyncio.TimeoutError: if the render took too long
+    :raises runicbabble.service.ServiceError: if the render service failed to render the message
+    """
+    key = render_key(message, fontsize, wrap, line_length)
+    if service.enabled():
+        try:
+            return _as_pages(await service.client().mdj(message, fontsize, wrap, line_length))
+        except OSError as e:
+            log.warning(f'The render service is unavailable ({e!r}), rendering locally')
+    return _as_pages(await render_encoded(key))
+
+
+async def render_encoded(key):
+    """
+    Get the encoded tiles for a render key (see `render_key`), from the cache or rendered in the worker pool.
+    """
+    tiles = _renders.get(key)
+    if tiles is None:
+        tiles = await _inflight.do(key, lambda: _render_and_store(key))
+    return tiles
+
+
+async def _render_and_store(key):
+    # the time spent waiting for and in the pool; the stages of the render itself are timed in the worker
+    with metrics.timed('render_pool'):
+        tiles, spans = await workers.pool().run(metrics.call_traced, _load_or_render, key)
+    metrics.record(spans)
+    return _renders.put(key, tiles)
+
+
+def _load_or_render(key):
+    directory = cfg.render.prerendered(None)
+    if directory is not None:
+        try:
+            # pre-rendered images are used as they are, even if they are taller than a tile
+            with open(os.path.join(directory, file_name(key)), 'rb') as f:
+                return f.read(),
+        except FileNotFoundError:
+            pass
+    return tuple(render_tiles(*key))
+
+
+def warmup(sizes=(32,)):
+    """
+    Load the font and pre-rasterize the glyph atlas for the given font sizes, so the first request doesn't pay for it.
+    """
+    for size in sizes:
+        atlas.get(fonts.load(fonts.MADOUJI_PATH, size), charset)
 
-    font = ImageFont.truetype(path, fontsize)
-    size = font.getsize_multiline(msg)
-    img = Image.new("RGBA", size, (0, 0, 0, 0))
-    draw = ImageDraw.Draw(img)
 
-    draw.text((0, 0), msg, (255, 255, 255), font=font)
+def cache_stats():
+    return {**_renders.stats(), 'coalesced': _inflight.coalesced, 'in_flight': len(_inflight)}
 
-    with io.BytesIO() as image_binary:
-        img.save(image_binary, 'PNG')
-        image_binary.seek(0)
-        img_file = discord.File(fp=image_binary, filename='mdj.png')
 
-    return {'file': img_file}
+metrics.register('render_cache', cache_stats)
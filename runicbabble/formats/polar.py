@@ -0,0 +1,86 @@
+import math
+
+import numpy as np
+from PIL import Image
+
+
+def warp_ring(strip: Image.Image, size, center, inner, outer, rotation=0.0, color=(255, 255, 255), samples=2,
+              chunk=65536):
+    """
+    Map a horizontal strip of text onto an annulus. The strip's x axis runs clockwise around the ring, starting at
+    `rotation` degrees (clockwise from the top), and its top edge lies on the outer radius. Only the pixels touching
+    the annulus are computed, each as the average of `samples` x `samples` bilinearly interpolated points.
+
+    :param strip: an 8-bit mask of the text; it may be at a higher resolution than the output
+    :param size: the size of the resulting image
+    :param center: the center of the ring
+    :param inner: the inner radius of the ring
+    :param outer: the outer radius of the ring
+    :param rotation: where the start of the strip is placed
+    :param color: the color of the text
+    :param samples: the amount of samples per pixel along each axis, for antialiasing
+    :param chunk: how many pixels to sample at once
+    :return: an RGBA image of the given size
+    """
+    cx, cy = center
+    mask = np.asarray(strip, dtype=np.float32)
+    strip_height, strip_width = mask.shape
+
+    left, top = max(int(cx - outer) - 1, 0), max(int(cy - outer) - 1, 0)
+    right, bottom = min(int(math.ceil(cx + outer)) + 1, size[0]), min(int(math.ceil(cy + outer)) + 1, size[1])
+    if right <= left or bottom <= top:
+        return Image.new('RGBA', size, (0, 0, 0, 0))
+
+    # pixel centers relative to the ring's center; only those close to the annulus are sampled
+    h, w = bottom - top, right - left
+    py, px = np.mgrid[top:bottom, left:right].astype(np.float32)
+    px += 0.5 - cx
+    py += 0.5 - cy
+    distance = np.hypot(px, py)
+    near = (distance >= inner - 1.5) & (distance <= outer + 1.5)
+
+    offsets = (np.arange(samples, dtype=np.float32) + 0.5) / samples - 0.5
+    ox, oy = np.meshgrid(offsets, offsets)
+    ox, oy = ox.ravel()[None, :], oy.ravel()[None, :]
+    px, py = px[near], py[near]
+    coverage = np.empty(px.shape, dtype=np.float32)
+
+    # the per-sample temporaries are the largest allocations, so they are computed a chunk at a time
+    for start in range(0, len(px), chunk):
+        dx = px[start:start + chunk, None] + ox
+        dy = py[start:start + chunk, None] + oy
+
+        r = np.hypot(dx, dy)
+        # angle measured clockwise from the top, in turns
+        theta = (np.arctan2(dx, -dy) / (2 * math.pi) - rotation / 360) % 1.0
+
+        sx = theta * strip_width - 0.5
+        sy = (outer - r) / (outer - inner) * strip_height - 0.5
+        values = _bilinear(mask, sx, sy)
+        values[(sy < -0.5) | (sy > strip_height - 0.5)] = 0
+        coverage[start:start + chunk] = values.mean(axis=1)
+
+    alpha = np.zeros((h, w), dtype=np.float32)
+    alpha[near] = coverage
+
+    ring = Image.new('RGBA', size, (0, 0, 0, 0))
+    box = Image.new('RGBA', (w, h), tuple(color[:3]) + (0,))
+    box.putalpha(Image.fromarray(np.clip(alpha + 0.5, 0, 255).astype(np.uint8), 'L'))
+    ring.paste(box, (left, top))
+    return ring
+
+
+def _bilinear(mask, x, y):
+    height, width = mask.shape
+    x0 = np.floor(x).astype(np.intp)
+    y0 = np.floor(y).astype(np.intp)
+    fx = x - x0
+    fy = y - y0
+    # the strip wraps around horizontally, but not vertically
+    x1 = (x0 + 1) % width
+    x0 = x0 % width
+    y1 = np.clip(y0 + 1, 0, height - 1)
+    y0 = np.clip(y0, 0, height - 1)
+    top = mask[y0, x0] * (1 - fx) + mask[y0, x1] * fx
+    bottom = mask[y1, x0] * (1 - fx) + mask[y1, x1] * fx
+    return top * (1 - fy) + bottom * fy
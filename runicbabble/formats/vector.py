@@ -0,0 +1,354 @@
+"""
+Vector output built from the glyph outlines in a font's FontForge source (the `.sfd` file next to the `.ttf`).
+
+The outlines of every glyph are parsed once into a `GlyphOutlines` table, in font units with the y axis pointing
+down and the origin at the top left of the glyph box, which is where Pillow puts the origin of drawn text. Glyphs are
+then placed with an affine matrix `(a, b, c, d, e, f)`, mapping a point (x, y) to (a*x + c*y + e, b*x + d*y + f)
+like SVG's `matrix()` does, and either written to SVG (every glyph is defined once and referenced with `<use>`) or
+filled directly at the final resolution with `rasterize`.
+"""
+import math
+import os
+
+from PIL import Image, ImageChops, ImageDraw
+
+from runicbabble.cache import LRUCache
+
+# see `atlas.SPACING`
+SPACING = 4
+
+
+class Glyph:
+    def __init__(self, name, advance, contours):
+        """
+        :param contours: a list of closed contours, each a list of segments: ('l', (x, y)) for lines and
+            ('c', (x1, y1), (x2, y2), (x, y)) for cubic Béziers, starting from the end of the last segment
+        """
+        self.name = name
+        self.advance = advance
+        self.contours = contours
+        self._polygons = None
+
+    @property
+    def path(self):
+        """
+        The outline as SVG path data.
+        """
+        parts = []
+        for contour in self.contours:
+            parts.append('M' + point(contour[0][1]))
+            for segment in contour[1:]:
+                parts.append(segment[0].upper() + ' '.join(point(p) for p in segment[1:]))
+            parts.append('Z')
+        return ''.join(parts)
+
+    def polygons(self, tolerance=1.0):
+        """
+        The contours with their curves flattened to lines that are at most about `tolerance` font units off.
+        """
+        if self._polygons is None:
+            self._polygons = [_flatten(contour, tolerance) for contour in self.contours]
+        return self._polygons
+
+
+class GlyphOutlines:
+    """
+    The outlines of all glyphs of a font, keyed by character.
+    """
+
+    def __init__(self, glyphs, ascent, descent):
+        self.glyphs = glyphs
+        self.ascent = ascent
+        self.descent = descent
+        self.em = ascent + descent
+        # characters the font doesn't have are left blank
+        self.missing = Glyph('.notdef', self.em // 2, [])
+
+    def glyph(self, c):
+        return self.glyphs.get(c, self.missing)
+
+    def scale(self, size):
+        """
+        :return: the size of a font unit in pixels for the font size `size`
+        """
+        return size / self.em
+
+    def advance(self, c, size):
+        return self.glyph(c).advance * self.scale(size)
+
+    def line_width(self, line, size):
+        return sum(self.advance(c, size) for c in line)
+
+    def line_spacing(self, size):
+        return int(round(self.em * self.scale(size))) + SPACING
+
+    def measure(self, text, size):
+        """
+        The size of (multiline) text in pixels, like `font.getsize_multiline(text)`.
+        """
+        lines = text.split('\n')
+        width = max(self.line_width(line, size) for line in lines)
+        return int(math.ceil(width)), len(lines) * self.line_spacing(size) - SPACING
+
+    def layout(self, text, size, matrix=(1, 0, 0, 1, 0, 0)):
+        """
+        Place (multiline) text with its top left corner at the origin of `matrix`.
+
+        :return: a generator of (character, matrix) for every non-blank glyph
+        """
+        k = self.scale(size)
+        y = 0
+        for line in text.split('\n'):
+            x = 0
+            for c in line:
+                if self.glyph(c).contours:
+                    yield c, multiply(matrix, (k, 0, 0, k, x, y))
+                x += self.advance(c, size)
+            y += self.line_spacing(size)
+
+
+def parse_sfd(lines):
+    """
+    Read the glyph outlines from a FontForge source file. Only the splines of the foreground layer are used; glyphs
+    without a Unicode code point, references and hints are ignored.
+
+    :param lines: an iterable of the lines of the file
+    """
+    ascent, descent = 800, 200
+    glyphs = {}
+    name = code = None
+    width = 0
+    contours = None
+    layer = None
+    in_splines = in_spiro = False
+
+    for line in lines:
+        line = line.strip()
+        if in_spiro:
+            in_spiro = line != 'EndSpiro'
+        elif in_splines:
+            if line == 'EndSplineSet':
+                in_splines = False
+            elif line == 'Spiro':
+                in_spiro = True
+            elif line and layer == 'Fore':
+                _parse_point(line, contours, ascent)
+        elif line.startswith('Ascent:'):
+            ascent = int(line.split()[1])
+        elif line.startswith('Descent:'):
+            descent = int(line.split()[1])
+        elif line.startswith('StartChar:'):
+            name, code, width, contours, layer = line.split(None, 1)[1], -1, 0, [], None
+        elif line.startswith('Encoding:') and name is not None:
+            code = int(line.split()[2])
+        elif line.startswith('Width:') and name is not None:
+            width = int(line.split()[1])
+        elif line in ('Fore', 'Back') or line.startswith('Layer:'):
+            layer = line
+        elif line == 'SplineSet':
+            in_splines = True
+        elif line == 'EndChar':
+            if code >= 0:
+                glyphs[chr(code)] = Glyph(name, width, [c for c in contours if c])
+            name = None
+    return GlyphOutlines(glyphs, ascent, descent)
+
+
+def _parse_point(line, contours, ascent):
+    tokens = line.split()
+    for i, token in enumerate(tokens):
+        if token in ('m', 'l', 'c'):
+            break
+    else:
+        return
+    numbers = [float(t) for t in tokens[:i]]
+    # flipped, so y grows downwards from the top of the glyph box
+    points = [(numbers[j], ascent - numbers[j + 1]) for j in range(0, len(numbers), 2)]
+    if token == 'm':
+        contours.append([])
+        contours[-1].append(('l', points[0]))
+    elif token == 'l':
+        contours[-1].append(('l', points[0]))
+    else:
+        contours[-1].append(('c', *points))
+
+
+def _flatten(contour, tolerance):
+    points = []
+    start = contour[-1][-1]
+    for segment in contour:
+        if segment[0] == 'l':
+            points.append(segment[1])
+        else:
+            p0, (p1, p2, p3) = start, segment[1:]
+            # the distance between a cubic and its chord is bounded by the control polygon
+            length = math.dist(p0, p1) + math.dist(p1, p2) + math.dist(p2, p3)
+            steps = max(1, min(64, int(math.ceil(math.sqrt(length / tolerance) / 2))))
+            for n in range(1, steps + 1):
+                t = n / steps
+                u = 1 - t
+                points.append((u**3 * p0[0] + 3 * u**2 * t * p1[0] + 3 * u * t**2 * p2[0] + t**3 * p3[0],
+                               u**3 * p0[1] + 3 * u**2 * t * p1[1] + 3 * u * t**2 * p2[1] + t**3 * p3[1]))
+        start = segment[-1]
+    return points
+
+
+_outlines = LRUCache(maxsize=8)
+
+
+def outlines(font_path):
+    """
+    Get the shared outline table for a font, reading it from the `.sfd` file next to the font file on first use.
+    """
+    def load():
+        with open(os.path.splitext(font_path)[0] + '.sfd', encoding='utf-8', errors='replace') as f:
+            return parse_sfd(f)
+
+    return _outlines.get_or_create(font_path, load)
+
+
+def multiply(m1, m2):
+    """
+    The matrix that applies `m2` first and then `m1`.
+    """
+    a1, b1, c1, d1, e1, f1 = m1
+    a2, b2, c2, d2, e2, f2 = m2
+    return (a1 * a2 + c1 * b2, b1 * a2 + d1 * b2, a1 * c2 + c1 * d2, b1 * c2 + d1 * d2,
+            a1 * e2 + c1 * f2 + e1, b1 * e2 + d1 * f2 + f1)
+
+
+def translate(x, y):
+    return 1, 0, 0, 1, x, y
+
+
+def rotate(degrees, center=(0, 0)):
+    """
+    A rotation by `degrees` clockwise on screen (where y grows downwards), around `center`.
+    """
+    cos, sin = math.cos(math.radians(degrees)), math.sin(math.radians(degrees))
+    cx, cy = center
+    return cos, sin, -sin, cos, cx - cos * cx + sin * cy, cy - sin * cx - cos * cy
+
+
+def transform(matrix, point):
+    a, b, c, d, e, f = matrix
+    x, y = point
+    return a * x + c * y + e, b * x + d * y + f
+
+
+def rasterize(mask, outlines: GlyphOutlines, placed, supersample=4):
+    """
+    Fill glyphs into an 8-bit mask. Every glyph is drawn at `supersample` times the resolution of the mask, but only
+    over its own bounding box, so the memory needed does not depend on the size of the mask.
+
+    :param placed: an iterable of (character, matrix), see `GlyphOutlines.layout`
+    """
+    for c, matrix in placed:
+        scaled = multiply((supersample, 0, 0, supersample, 0, 0), matrix)
+        polygons = [[transform(scaled, p) for p in polygon] for polygon in outlines.glyph(c).polygons()]
+        xs = [x for polygon in polygons for x, _ in polygon]
+        ys = [y for polygon in polygons for _, y in polygon]
+        left, top = max(int(min(xs) // supersample), 0), max(int(min(ys) // supersample), 0)
+        right = min(int(math.ceil(max(xs) / supersample)), mask.width)
+        bottom = min(int(math.ceil(max(ys) / supersample)), mask.height)
+        if right <= left or bottom <= top:
+            continue
+
+        tile = Image.new('L', ((right - left) * supersample, (bottom - top) * supersample), 0)
+        contour = Image.new('L', tile.size, 0)
+        draw = ImageDraw.Draw(contour)
+        for polygon in polygons:
+            draw.rectangle((0, 0) + tile.size, 0)
+            draw.polygon([(x - left * supersample, y - top * supersample) for x, y in polygon], 255)
+            # even-odd fill: contours inside another one cut holes into it
+            tile = ImageChops.difference(tile, contour)
+
+        box = (left, top, right, bottom)
+        mask.paste(ImageChops.lighter(mask.crop(box), tile.reduce(supersample)), box)
+    return mask
+
+
+class SVG:
+    """
+    Builds an SVG document. Glyphs are defined once in `<defs>` and referenced wherever they are used.
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.defs = {}
+        self.elements = []
+        self._fonts = {}
+
+    def glyphs(self, outlines: GlyphOutlines, placed, color):
+        """
+        Add glyphs in one color.
+
+        :param placed: an iterable of (character, matrix), see `GlyphOutlines.layout`
+        """
+        font = self._fonts.setdefault(id(outlines), len(self._fonts))
+        placed = list(placed)
+        if not placed:
+            return
+        # plain text only moves the glyphs, so one scale for all of them is enough
+        k = placed[0][1][0]
+        scaled = k and all(m[:4] == (k, 0, 0, k) for _, m in placed)
+        uses = []
+        for c, matrix in placed:
+            glyph_id = f'g{font}-{ord(c):x}'
+            if glyph_id not in self.defs:
+                self.defs[glyph_id] = f'<path id="{glyph_id}" d="{outlines.glyph(c).path}"/>'
+            if scaled:
+                position = f'x="{number(matrix[4] / k)}" y="{number(matrix[5] / k)}"'
+            else:
+                position = f'transform="matrix({" ".join(map(number, matrix))})"'
+            uses.append(f'<use xlink:href="#{glyph_id}" {position}/>')
+        transform = f' transform="scale({number(k)})"' if scaled else ''
+        self.elements.append(f'<g {paint("fill", color)}{transform}>{"".join(uses)}</g>')
+
+    def circle(self, center, radius, fill=None, outline=None, width=1):
+        self.elements.append(f'<circle cx="{number(center[0])}" cy="{number(center[1])}" r="{number(radius)}" '
+                             f'{paint("fill", fill)}{_stroke(outline, width)}/>')
+
+    def path(self, d, fill=None, outline=None, width=1):
+        self.elements.append(f'<path d="{d}" {paint("fill", fill)}{_stroke(outline, width)}/>')
+
+    def __str__(self):
+        return (f'<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+                f'width="{self.width}" height="{self.height}" viewBox="0 0 {self.width} {self.height}">'
+                f'<defs>{"".join(self.defs.values())}</defs>{"".join(self.elements)}</svg>')
+
+    def encode(self):
+        return str(self).encode()
+
+
+def paint(attribute, color):
+    """
+    An SVG fill or stroke attribute for an RGB(A) color tuple, or 'none' if the color is None.
+    """
+    if color is None:
+        return f'{attribute}="none"'
+    value = f'{attribute}="#{color[0]:02x}{color[1]:02x}{color[2]:02x}"'
+    if len(color) > 3 and color[3] != 255:
+        value += f' {attribute}-opacity="{number(color[3] / 255)}"'
+    return value
+
+
+def _stroke(color, width):
+    if color is None:
+        return ''
+    return f' {paint("stroke", color)} stroke-width="{number(width)}"'
+
+
+def number(x):
+    """
+    Format a coordinate for SVG, with at most three decimals.
+    """
+    return f'{x:.3f}'.rstrip('0').rstrip('.') if x % 1 else str(int(x))
+
+
+def point(p):
+    """
+    Format a point for SVG path data.
+    """
+    return f'{number(p[0])} {number(p[1])}'
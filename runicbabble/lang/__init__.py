@@ -1,14 +1,29 @@
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
 from abc import ABC, abstractmethod
 import logging
+import re
+
+from runicbabble import fonts
+from runicbabble.formats import encode
+
 log = logging.getLogger(__name__)
 
 langs = []
+# languages with a prefix are found through a single regex match, the others are asked one by one
+_prefixed = []
+_unprefixed = []
+_dispatch = None
 
 
 class Language(ABC):
     def register(self):
+        global _dispatch
         langs.append(self)
+        if self.prefix is not None:
+            _prefixed.append(self)
+            _dispatch = re.compile('|'.join(f'(?P<l{i}>{re.escape(lang.prefix)})' for i, lang in enumerate(_prefixed)))
+        else:
+            _unprefixed.append(self)
         log.info(f'Registered language {self.name}')
 
     @property
@@ -16,6 +31,13 @@ class Language(ABC):
     def name(self):
         pass
 
+    @property
+    def prefix(self):
+        """
+        A string every message this language is responsible for starts with, or None if there is no such string.
+        """
+        return None
+
     @abstractmethod
     def is_responsible(self, message):
         pass
@@ -28,26 +50,46 @@ class Language(ABC):
     def font_path(self, message):
         pass
 
-    def render_message(self, message, fontsize):
+    def render_mask(self, message, fontsize):
+        """
+        Render the message as an 8-bit coverage mask, which `runicbabble.formats.encode` can color and encode.
+        """
         if not self.is_responsible(message):
             return None
         path = self.font_path(message)
         msg = self.format(message)
 
-        font = ImageFont.truetype(path, fontsize)
-        size = font.getsize_multiline(msg)
-        img = Image.new("RGBA", size, (0, 0, 0, 0))
-        draw = ImageDraw.Draw(img)
+        font = fonts.load(path, fontsize)
+        mask = Image.new('L', font.getsize_multiline(msg), 0)
+        ImageDraw.Draw(mask).text((0, 0), msg, 255, font=font)
+        return mask
 
-        draw.text((0, 0), msg, (255, 255, 255), font=font)
-        return img
+    def render_message(self, message, fontsize):
+        mask = self.render_mask(message, fontsize)
+        if mask is None:
+            return None
+        return encode.colorize(mask)
 
 
-def render(message, fontsize=32):
-    img = None
-    for lang in langs:
-        img = lang.render_message(message, fontsize)
-        if img is not None:
-            break
+def responsible_language(message):
+    if _dispatch is not None:
+        m = _dispatch.match(message)
+        if m is not None:
+            lang = _prefixed[int(m.lastgroup[1:])]
+            if lang.is_responsible(message):
+                return lang
+            # another language's prefix may overlap with the one that matched first
+            for lang in _prefixed:
+                if message.startswith(lang.prefix) and lang.is_responsible(message):
+                    return lang
+    for lang in _unprefixed:
+        if lang.is_responsible(message):
+            return lang
+    return None
 
-    return img
+
+def render(message, fontsize=32):
+    lang = responsible_language(message)
+    if lang is None:
+        return None
+    return lang.render_message(message, fontsize)
@@ -0,0 +1,356 @@
+"""
+Timers and counters for the stages of handling a request (transliteration, wrapping, font loading, rasterization,
+encoding, webhook lookup, upload and so on), together with gauges for cache hit rates and queue depths.
+
+Stage times are collected in histograms with fixed buckets, so recording one costs a bisect and a few additions.
+Everything can be read as Prometheus text from `metrics.port` (see `serve`), or summarized by the /stats command.
+`profile(n)` runs cProfile over the next n requests.
+"""
+import bisect
+import contextlib
+import functools
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+from runicbabble.config import cfg
+
+log = logging.getLogger(__name__)
+
+# upper bounds in seconds: four per decade, from 0.1ms to 100s
+BUCKETS = tuple(10 ** (e / 4) for e in range(-16, 9))
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # the last count is for values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Estimate a quantile by interpolating within its bucket, the way Prometheus' `histogram_quantile` does.
+
+        :return: the estimate in seconds, or None if nothing was observed
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                if i == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99)
+        }
+
+
+_lock = threading.Lock()
+_histograms = defaultdict(Histogram)
+_counters = defaultdict(int)
+_gauges = {}
+
+
+class _Local(threading.local):
+    # see `trace`
+    spans = None
+
+
+_local = _Local()
+
+
+def observe(stage, seconds):
+    """
+    Record how long a stage took.
+    """
+    spans = _local.spans
+    if spans is not None:
+        spans.append((stage, seconds))
+        return
+    with _lock:
+        _histograms[stage].observe(seconds)
+
+
+def record(spans):
+    """
+    Record the stage times collected by `trace`.
+    """
+    for stage, seconds in spans:
+        observe(stage, seconds)
+
+
+def count(name, n=1):
+    with _lock:
+        _counters[name] += n
+
+
+def register(name, stats):
+    """
+    Add gauges read on every collection.
+
+    :param stats: a function returning a number, or a dict of numbers like the `stats()` functions of the caches and
+        pools; other values are left out
+    """
+    _gauges[name] = stats
+
+
+class timed(contextlib.ContextDecorator):
+    """
+    Time the body of a `with` block, or every call of a decorated function, as a stage, whether or not it raises.
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.start = None
+
+    def _recreate_cm(self):
+        # a decorated function may run in several threads at once
+        return timed(self.stage)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+def timed_iter(stage, iterable):
+    """
+    Time how long it takes to produce the items of a (lazy) iterable, recorded once it is exhausted or closed.
+    """
+    elapsed = 0.0
+    iterator = iter(iterable)
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                elapsed += time.perf_counter() - start
+                return
+            elapsed += time.perf_counter() - start
+            yield item
+    finally:
+        observe(stage, elapsed)
+
+
+@contextlib.contextmanager
+def trace():
+    """
+    Collect the stage times recorded by this thread in a list instead of the histograms, so a worker process can
+    send them back with its result, see `call_traced`.
+    """
+    spans = []
+    _local.spans = spans
+    try:
+        yield spans
+    finally:
+        _local.spans = None
+
+
+def call_traced(fn, *args):
+    """
+    Run `fn(*args)` in a worker. The caller records the stage times it returns.
+
+    :return: a tuple (result, spans)
+    """
+    with trace() as spans:
+        return fn(*args), spans
+
+
+_profiler = None
+_profile_remaining = 0
+_profile_active = 0
+last_profile = None
+
+
+def profile(requests):
+    """
+    Profile the next `requests` requests with cProfile. The profile is saved to `metrics.profile_dir` when they are
+    done, and the slowest functions are logged. Only the code running in this process is profiled, so renders in a
+    process pool are not included.
+    """
+    global _profiler, _profile_remaining
+    import cProfile
+    if _profiler is None:
+        _profiler = cProfile.Profile()
+    _profile_remaining = requests
+
+
+def profiling():
+    """
+    :return: how many of the requests to profile have not started yet
+    """
+    return _profile_remaining
+
+
+@contextlib.contextmanager
+def request(name):
+    """
+    Count and time a whole request, profiling it if a profile is running (see `profile`). The profiler is on while
+    any profiled request is running, so concurrent requests are part of the profile as well.
+    """
+    global _profile_remaining, _profile_active
+    count(f'{name}_requests')
+    profiled = _profile_remaining > 0
+    if profiled:
+        _profile_remaining -= 1
+        if _profile_active == 0:
+            _profiler.enable()
+        _profile_active += 1
+    try:
+        with timed(name):
+            yield
+    finally:
+        if profiled:
+            _profile_active -= 1
+            if _profile_active == 0:
+                _profiler.disable()
+                if _profile_remaining == 0:
+                    _save_profile()
+
+
+def instrumented(name):
+    """
+    Decorator for a coroutine function that handles a request, see `request`.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with request(name):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _save_profile():
+    global _profiler, last_profile
+    import io
+    import pstats
+
+    directory = cfg.metrics.profile_dir('profiles')
+    os.makedirs(directory, exist_ok=True)
+    last_profile = os.path.join(directory, f'{time.strftime("%Y%m%d-%H%M%S")}.prof')
+    _profiler.dump_stats(last_profile)
+    out = io.StringIO()
+    pstats.Stats(_profiler, stream=out).sort_stats('cumulative').print_stats(15)
+    log.info(f'Saved profile to {last_profile}\n{out.getvalue()}')
+    _profiler = None
+
+
+def snapshot():
+    """
+    :return: a dict with a summary of every stage (see `Histogram.summary`), the counters and the gauges
+    """
+    with _lock:
+        stages = {stage: h.summary() for stage, h in _histograms.items()}
+        counters = dict(_counters)
+    return {'stages': stages, 'counters': counters, 'gauges': gauges()}
+
+
+def gauges():
+    values = {}
+    for name, stats in list(_gauges.items()):
+        try:
+            _flatten(name, stats(), values)
+        except Exception:
+            log.exception(f'Reading the "{name}" metrics failed')
+    return values
+
+
+def _flatten(name, value, values):
+    if isinstance(value, dict):
+        for key, v in value.items():
+            _flatten(f'{name}_{key}', v, values)
+    elif isinstance(value, (int, float)):
+        values[name] = float(value)
+
+
+def prometheus():
+    """
+    All metrics in the Prometheus text exposition format.
+    """
+    with _lock:
+        histograms = {stage: (list(h.counts), h.sum, h.count) for stage, h in _histograms.items()}
+        counters = dict(_counters)
+
+    lines = ['# TYPE runicbabble_stage_seconds histogram']
+    for stage, (counts, total, n) in sorted(histograms.items()):
+        cumulative = 0
+        for bound, c in zip(BUCKETS, counts):
+            cumulative += c
+            lines.append(f'runicbabble_stage_seconds_bucket{{stage="{stage}",le="{bound:.6g}"}} {cumulative}')
+        lines.append(f'runicbabble_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {n}')
+        lines.append(f'runicbabble_stage_seconds_sum{{stage="{stage}"}} {total}')
+        lines.append(f'runicbabble_stage_seconds_count{{stage="{stage}"}} {n}')
+    for name, value in sorted(counters.items()):
+        lines.append(f'# TYPE runicbabble_{name}_total counter')
+        lines.append(f'runicbabble_{name}_total {value}')
+    for name, value in sorted(gauges().items()):
+        lines.append(f'# TYPE runicbabble_{name} gauge')
+        lines.append(f'runicbabble_{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+async def serve(host='127.0.0.1', port=9464):
+    """
+    Serve `prometheus()` at http://host:port/metrics.
+    """
+    from aiohttp import web
+
+    async def handle(_):
+        return web.Response(body=prometheus().encode(),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info(f'Serving metrics on http://{host}:{port}/metrics')
+    return runner
+
+
+def report(stats=None):
+    """
+    A plain text summary of a `snapshot()`: stage times, counters, cache hit rates and queue depths.
+    """
+    stats = stats or snapshot()
+
+    def ms(seconds):
+        return '-' if seconds is None else f'{seconds * 1000:.1f}'
+
+    lines = [f'{"stage":18}{"count":>8}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}']
+    for stage, s in sorted(stats['stages'].items()):
+        lines.append(f'{stage:18}{s["count"]:>8}{ms(s["p50"]):>9}{ms(s["p95"]):>9}{ms(s["p99"]):>9}')
+    if stats['counters']:
+        lines.append('')
+        lines.extend(f'{name:34}{value:>8}' for name, value in sorted(stats['counters'].items()))
+    shown = {name: value for name, value in stats['gauges'].items()
+             if name.endswith(('hit_rate', 'pending', 'waiting', 'in_flight', 'size'))}
+    if shown:
+        lines.append('')
+        lines.extend(f'{name:34}{value:>8.3g}' for name, value in sorted(shown.items()))
+    return '\n'.join(lines)
@@ -0,0 +1,178 @@
+import asyncio
+import bisect
+import itertools
+import logging
+import time
+
+from runicbabble.cache import LRUCache
+
+log = logging.getLogger(__name__)
+
+# priorities, lower values are sent first
+SLASH = 0
+REWRITE = 1
+
+
+class QueueFull(Exception):
+    """
+    Raised when more requests of one priority are waiting than the scheduler accepts.
+    """
+    pass
+
+
+class Bucket:
+    """
+    A token bucket allowing `capacity` requests per `per` seconds.
+    """
+
+    def __init__(self, capacity, per):
+        self.capacity = capacity
+        self.per = per
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / self.per)
+        self.updated = now
+
+    def delay(self, now):
+        """
+        :return: how many seconds to wait until a request may be made, 0 if one may be made right away
+        """
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) * self.per / self.capacity
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class _Job:
+    def __init__(self, priority, seq, key, factory, future):
+        self.priority = priority
+        self.seq = seq
+        self.key = key
+        self.factory = factory
+        self.future = future
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class OutboundScheduler:
+    """
+    Sends outbound requests through per-route token buckets, so that bursts wait in a queue instead of running into
+    Discord's rate limits inside the event handlers. Waiting requests are sent by priority, and in submission order
+    within a priority. Requests for different buckets don't hold each other up.
+
+    :param rates: a dict from bucket kinds (the first element of a bucket key) to (capacity, seconds) tuples
+    :param max_depth: how many requests of each priority may wait at most
+    """
+
+    def __init__(self, rates, default_rate=(5, 5), max_depth=100):
+        self.rates = rates
+        self.default_rate = default_rate
+        self.max_depth = max_depth
+
+        # idle buckets of channels that went quiet are forgotten eventually
+        self._buckets = LRUCache(maxsize=4096)
+        self._waiting = []
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._runner = None
+
+        self.in_flight = 0
+        self.sent = 0
+        self.rejected = 0
+
+    def depth(self, priority=None):
+        if priority is None:
+            return len(self._waiting)
+        return sum(1 for job in self._waiting if job.priority == priority)
+
+    def check_capacity(self, priority):
+        """
+        :raises QueueFull: if too many requests of this priority are already waiting
+        """
+        if self.depth(priority) >= self.max_depth:
+            self.rejected += 1
+            raise QueueFull()
+
+    async def submit(self, key, factory, priority=REWRITE, bounded=True):
+        """
+        Queue a request and wait for its result.
+
+        :param key: the bucket the request counts against, like ('channel', channel.id)
+        :param factory: a function returning the coroutine that makes the request
+        :param priority: `SLASH` or `REWRITE`
+        :param bounded: whether to check the queue depth; requests that are part of an operation which was already
+            admitted with `check_capacity` should not be rejected halfway through
+        :raises QueueFull: if too many requests of this priority are already waiting
+        """
+        if bounded:
+            self.check_capacity(priority)
+
+        future = asyncio.get_running_loop().create_future()
+        bisect.insort(self._waiting, _Job(priority, next(self._seq), key, factory, future))
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        self._wakeup.set()
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.ensure_future(self._run())
+        return await future
+
+    def _bucket(self, key):
+        return self._buckets.get_or_create(key, lambda: Bucket(*self.rates.get(key[0], self.default_rate)))
+
+    async def _run(self):
+        while self._waiting:
+            self._wakeup.clear()
+            now = time.monotonic()
+            wait = None
+            for job in list(self._waiting):
+                if job.future.done():
+                    # the submitter gave up waiting
+                    self._waiting.remove(job)
+                    continue
+                delay = self._bucket(job.key).delay(now)
+                if delay > 0:
+                    wait = delay if wait is None else min(wait, delay)
+                    continue
+                self._bucket(job.key).take(now)
+                self._waiting.remove(job)
+                asyncio.ensure_future(self._send(job))
+            if wait is not None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _send(self, job):
+        self.in_flight += 1
+        try:
+            result = await job.factory()
+        except asyncio.CancelledError:
+            job.future.cancel()
+            raise
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self.in_flight -= 1
+            self.sent += 1
+
+    def stats(self):
+        return {
+            'waiting': len(self._waiting),
+            'waiting_slash': self.depth(SLASH),
+            'waiting_rewrite': self.depth(REWRITE),
+            'in_flight': self.in_flight,
+            'sent': self.sent,
+            'rejected': self.rejected,
+            'buckets': len(self._buckets)
+        }
@@ -0,0 +1,195 @@
+"""
+Render Madouji phrases to image files without running the bot.
+
+The input is either a text file with one phrase per line, or a JSONL file with one object per line:
+`{"text": "...", "wrap": "flow", "line_width": 12, "font_size": 32, "name": "greeting"}`, where everything except
+`text` is optional and defaults to the command line options. Phrases are streamed from the input and rendered in a
+process pool, and outputs that are already up to date are skipped.
+
+Outputs with a `name` are written as `<name>.png`. All others are named after their render key, the same way the
+bot looks them up in its `render.prerendered` directory, so pointing that setting at the output directory makes the
+bot serve these files instead of rendering them again.
+
+Run from the repository root: python -m runicbabble.render phrases.txt -o rendered/
+"""
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import sys
+import time
+
+from runicbabble import fonts, text
+from runicbabble.config import cfg
+
+log = logging.getLogger(__name__)
+
+
+class Job:
+    def __init__(self, line_number, message, font_size, wrap, line_width, name=None, error=None):
+        self.line_number = line_number
+        self.message = message
+        self.font_size = font_size
+        self.wrap = wrap
+        self.line_width = line_width
+        self.name = name
+        # why the input line could not be read, such jobs are counted as failed
+        self.error = error
+
+
+def read_jobs(lines, kind, defaults):
+    """
+    Parse the input a line at a time.
+
+    :param lines: an iterable of input lines
+    :param kind: 'text' or 'jsonl'
+    :param defaults: a dict with the font_size, wrap and line_width to use where the input doesn't specify them
+    :return: a generator of `Job`s, with `error` set for lines that are not valid entries
+    """
+    for line_number, line in enumerate(lines, 1):
+        line = line.rstrip('\n')
+        if not line.strip():
+            continue
+        if kind == 'text':
+            yield Job(line_number, line, **defaults)
+            continue
+        try:
+            entry = json.loads(line)
+            yield Job(line_number, entry['text'],
+                      font_size=int(entry.get('font_size', defaults['font_size'])),
+                      wrap=entry.get('wrap', defaults['wrap']),
+                      line_width=int(entry.get('line_width', defaults['line_width'])),
+                      name=entry.get('name'))
+        except (ValueError, KeyError, TypeError) as e:
+            yield Job(line_number, None, error=f'invalid entry ({e!r})', **defaults)
+
+
+def output_path(job, directory, format):
+    from runicbabble.formats import mdj_image
+    if job.name is not None:
+        return os.path.join(directory, f'{job.name}.{mdj_image.extension(format)}')
+    key = mdj_image.render_key(job.message, job.font_size, job.wrap, job.line_width)
+    return os.path.join(directory, mdj_image.file_name(key, format))
+
+
+def up_to_date(path, newer_than):
+    try:
+        return os.stat(path).st_mtime >= newer_than
+    except FileNotFoundError:
+        return False
+
+
+def render_file(message, font_size, wrap, line_width, path, format):
+    """
+    Render one phrase into a file. Runs in the worker processes.
+
+    :return: the size of the written file
+    """
+    from runicbabble.formats import mdj_image
+    if format == 'svg':
+        data = mdj_image.render_svg(message, font_size, wrap, line_width)
+    else:
+        data = mdj_image.render_png(message, font_size, wrap, line_width, format=format)
+    # written under a temporary name first, so an interrupted run never leaves a partial file that looks up to date
+    temporary = f'{path}.tmp{os.getpid()}'
+    with open(temporary, 'wb') as f:
+        f.write(data)
+    os.replace(temporary, path)
+    return len(data)
+
+
+def render_all(jobs, directory, format, workers, force=False, newer_than=0.0, named_newer_than=None, window=None):
+    """
+    Render jobs in a process pool. At most `window` jobs are queued at once, so the input is only read as fast as
+    the workers can render it.
+
+    :param newer_than: outputs modified at or after this time are up to date
+    :param named_newer_than: the same for named outputs, defaults to `newer_than`
+    :return: a dict with the counts of rendered, skipped and failed jobs and the bytes written
+    """
+    counts = {'rendered': 0, 'skipped': 0, 'failed': 0, 'bytes': 0}
+    window = window or workers * 4
+    jobs = iter(jobs)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        exhausted = False
+        while True:
+            # skipped jobs don't take a place in the window, so keep reading until it is full or the input ends
+            while not exhausted and len(pending) < window:
+                job = next(jobs, None)
+                if job is None:
+                    exhausted = True
+                    break
+                if job.error is not None:
+                    log.error(f'Line {job.line_number}: {job.error}, skipping')
+                    counts['failed'] += 1
+                    continue
+                if job.wrap not in text.wrap_modes:
+                    log.error(f'Line {job.line_number}: unknown wrap mode "{job.wrap}", skipping')
+                    counts['failed'] += 1
+                    continue
+                path = output_path(job, directory, format)
+                newer = named_newer_than if job.name is not None and named_newer_than is not None else newer_than
+                if not force and up_to_date(path, newer):
+                    counts['skipped'] += 1
+                    continue
+                future = pool.submit(render_file, job.message, job.font_size, job.wrap, job.line_width, path, format)
+                pending[future] = job
+            if not pending and exhausted:
+                break
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                job = pending.pop(future)
+                try:
+                    counts['bytes'] += future.result()
+                    counts['rendered'] += 1
+                except Exception as e:
+                    log.error(f'Line {job.line_number}: rendering failed ({e!r})')
+                    counts['failed'] += 1
+    return counts
+
+
+def main(argv=None):
+    from runicbabble.formats import encode
+
+    parser = argparse.ArgumentParser(prog='python -m runicbabble.render',
+                                     description='Render Madouji phrases to image files.')
+    parser.add_argument('input', help='a text file with one phrase per line, a .jsonl file, or - for stdin')
+    parser.add_argument('-o', '--output', default='rendered', help='the directory to write the images to')
+    parser.add_argument('--input-format', choices=('text', 'jsonl'), default=None,
+                        help='how to read the input, by default guessed from its file extension')
+    parser.add_argument('--wrap', choices=text.wrap_modes, default='none')
+    parser.add_argument('--line-width', type=int, default=8)
+    parser.add_argument('--font-size', type=int, default=32)
+    parser.add_argument('--image-format', choices=encode.formats + ('svg',), default=cfg.render.format('palette'),
+                        help='svg draws the glyph outlines as vector graphics')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2)
+    parser.add_argument('--force', action='store_true', help='render everything, even outputs that are up to date')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s %(message)s')
+    kind = args.input_format or ('jsonl' if args.input.endswith('.jsonl') else 'text')
+    os.makedirs(args.output, exist_ok=True)
+
+    # an output is up to date if it was written after the font last changed; named outputs also depend on the input
+    font_changed = os.stat(fonts.MADOUJI_PATH).st_mtime
+    input_changed = font_changed if args.input == '-' else max(font_changed, os.stat(args.input).st_mtime)
+    defaults = {'font_size': args.font_size, 'wrap': args.wrap, 'line_width': args.line_width}
+
+    start = time.perf_counter()
+    lines = sys.stdin if args.input == '-' else open(args.input, encoding='utf-8')
+    try:
+        counts = render_all(read_jobs(lines, kind, defaults), args.output, args.image_format, args.workers,
+                            args.force, font_changed, input_changed)
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+    elapsed = time.perf_counter() - start
+    log.info(f'Rendered {counts["rendered"]} ({counts["bytes"] / 1024:.0f}KB), skipped {counts["skipped"]} up to '
+             f'date, {counts["failed"]} failed in {elapsed:.1f}s')
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
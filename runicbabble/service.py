@@ -0,0 +1,312 @@
+"""
+A render service that any number of bot processes (shards) can share, so fonts, glyph atlases and rendered images
+are only loaded and cached once per machine instead of once per shard.
+
+The service listens on a Unix socket and renders in its own worker pool (`render.workers`), so it scales with the
+number of workers rather than the number of shards. Shards use it when `render.service.socket` is set.
+
+Every message on the socket is a frame: a 4-byte big-endian length, a JSON header of that length, and
+`header['length']` bytes of payload. Requests are `{"id": 1, "method": "mdj", "params": {...}}` without payload;
+responses are `{"id": 1, "ok": true, "length": n}` with the encoded image as payload (several images are sent one
+after the other, with their sizes in `header['parts']`), or
+`{"id": 1, "ok": false, "error": "saturated" | "timeout" | "failed", "message": "..."}`. Requests on one connection
+are answered as soon as they are done, not in order.
+
+Run the service from the repository root: python -m runicbabble.service [--socket PATH]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import signal
+import struct
+
+from runicbabble import metrics, workers
+from runicbabble.cache import LRUCache, SingleFlight
+from runicbabble.config import cfg
+
+log = logging.getLogger(__name__)
+
+_length = struct.Struct('>I')
+
+
+class ServiceError(Exception):
+    """
+    Raised when the render service failed to render a request.
+    """
+    pass
+
+
+async def read_frame(reader: asyncio.StreamReader):
+    """
+    :return: a tuple (header, payload)
+    :raises asyncio.IncompleteReadError: if the connection was closed
+    """
+    size, = _length.unpack(await reader.readexactly(_length.size))
+    header = json.loads(await reader.readexactly(size))
+    payload = await reader.readexactly(header.get('length', 0))
+    return header, payload
+
+
+def write_frame(writer: asyncio.StreamWriter, header, payload=b''):
+    """
+    :param payload: bytes, or a tuple of bytes objects
+    """
+    if isinstance(payload, tuple):
+        header = {**header, 'parts': [len(part) for part in payload]}
+        payload = b''.join(payload)
+    encoded = json.dumps({**header, 'length': len(payload)}).encode()
+    writer.write(_length.pack(len(encoded)) + encoded + payload)
+
+
+def split_payload(header, payload):
+    if 'parts' not in header:
+        return payload
+    parts, offset = [], 0
+    for size in header['parts']:
+        parts.append(payload[offset:offset + size])
+        offset += size
+    return tuple(parts)
+
+
+class RenderService:
+    """
+    The server side: answers render requests from any number of connections.
+    """
+
+    def __init__(self, path, pool: workers.WorkerPool):
+        self.path = path
+        self.pool = pool
+        self.connections = 0
+        self.requests = 0
+        self.errors = 0
+        self._circles = LRUCache(maxsize=None, weigh=len,
+                                 maxweight=int(cfg.render.service.circle_cache_bytes(32 * 1024 * 1024)))
+        self._circles_inflight = SingleFlight()
+        self.methods = {'mdj': self.mdj, 'circle': self.circle, 'stats': self.stats}
+        metrics.register('service', lambda: {'connections': self.connections, 'requests': self.requests,
+                                             'errors': self.errors})
+
+    async def mdj(self, message, fontsize, wrap='none', line_length=8):
+        from runicbabble.formats import mdj_image
+        return await mdj_image.render_encoded(mdj_image.render_key(message, fontsize, wrap, line_length))
+
+    async def circle(self, spec, format='png'):
+        from runicbabble.formats import circle
+        key = json.dumps([spec, format], sort_keys=True)
+        image = self._circles.get(key)
+        if image is None:
+            async def render():
+                image, spans = await self.pool.run(metrics.call_traced, circle.render_spec, spec, format)
+                metrics.record(spans)
+                return self._circles.put(key, image)
+            image = await self._circles_inflight.do(key, render)
+        return image
+
+    async def stats(self):
+        from runicbabble.formats import mdj_image
+        return json.dumps({
+            'service': {'connections': self.connections, 'requests': self.requests, 'errors': self.errors},
+            'pool': self.pool.stats(),
+            'renders': mdj_image.cache_stats(),
+            'circles': self._circles.stats(),
+            'metrics': metrics.snapshot()
+        }).encode()
+
+    async def serve(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self._handle, path=self.path)
+        log.info(f'Render service listening on {self.path} with {self.pool.workers} workers')
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                try:
+                    header, _ = await read_frame(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                task = asyncio.ensure_future(self._respond(header, writer, lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.connections -= 1
+            writer.close()
+
+    async def _respond(self, header, writer, lock):
+        self.requests += 1
+        reply = {'id': header.get('id'), 'ok': True}
+        payload = b''
+        try:
+            method = header.get('method')
+            with metrics.request(f'service_{method}' if method in self.methods else 'service_unknown'):
+                payload = await self.methods[header['method']](**header.get('params', {}))
+        except workers.Saturated:
+            reply.update(ok=False, error='saturated')
+        except asyncio.TimeoutError:
+            reply.update(ok=False, error='timeout')
+        except Exception as e:
+            log.exception(f'Render request {header!r} failed')
+            self.errors += 1
+            reply.update(ok=False, error='failed', message=repr(e))
+        async with lock:
+            write_frame(writer, reply, payload)
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+
+
+class RenderClient:
+    """
+    The shard side: sends requests to the render service over a single connection, which is opened on first use and
+    reopened after it was lost. Any number of requests can be waiting at once.
+    """
+
+    def __init__(self, path, timeout=None):
+        self.path = path
+        self.timeout = timeout
+        self._ids = itertools.count()
+        self._pending = {}
+        self._writer = None
+        self._receiver = None
+        self._connecting = None
+        self._closing = False
+
+    async def _connect(self):
+        if self._connecting is None:
+            self._connecting = asyncio.Lock()
+        async with self._connecting:
+            if self._writer is None:
+                reader, self._writer = await asyncio.open_unix_connection(self.path)
+                self._receiver = asyncio.ensure_future(self._receive(reader))
+        return self._writer
+
+    async def _receive(self, reader):
+        try:
+            while True:
+                header, payload = await read_frame(reader)
+                future = self._pending.pop(header.get('id'), None)
+                if future is not None and not future.done():
+                    future.set_result((header, payload))
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            if not self._closing:
+                log.warning(f'Lost the connection to the render service ({e!r})')
+        finally:
+            self._writer = None
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError('The connection to the render service was lost'))
+            self._pending.clear()
+
+    async def call(self, method, **params):
+        """
+        Make a request and wait for its payload, which is a tuple if the service sent several parts.
+
+        :raises OSError: if the service can't be reached
+        :raises runicbabble.workers.Saturated: if the service can not accept any more jobs
+        :raises asyncio.TimeoutError: if the render took too long
+        :raises ServiceError: if rendering failed
+        """
+        writer = await self._connect()
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            write_frame(writer, {'id': request_id, 'method': method, 'params': params})
+            await writer.drain()
+            header, payload = await asyncio.wait_for(future, self.timeout)
+        finally:
+            self._pending.pop(request_id, None)
+        if header['ok']:
+            return split_payload(header, payload)
+        if header['error'] == 'saturated':
+            raise workers.Saturated()
+        if header['error'] == 'timeout':
+            raise asyncio.TimeoutError()
+        raise ServiceError(header.get('message', header['error']))
+
+    async def mdj(self, message, fontsize, wrap='none', line_length=8):
+        return await self.call('mdj', message=message, fontsize=fontsize, wrap=wrap, line_length=line_length)
+
+    async def circle(self, spec, format='png'):
+        """
+        :param format: 'png' or 'svg'
+        """
+        return await self.call('circle', spec=spec, format=format)
+
+    async def stats(self):
+        return json.loads(await self.call('stats'))
+
+    async def close(self):
+        self._closing = True
+        if self._writer is not None:
+            self._writer.close()
+        if self._receiver is not None:
+            await asyncio.gather(self._receiver, return_exceptions=True)
+
+
+_client = None
+
+
+def enabled():
+    return cfg.render.service.socket(None) is not None
+
+
+def client():
+    """
+    The shared client for the render service at `render.service.socket`.
+    """
+    global _client
+    if _client is None:
+        # the service applies its own render timeout, this only catches a service that stopped answering
+        _client = RenderClient(cfg.render.service.socket(), timeout=float(cfg.render.timeout(10)) * 2)
+    return _client
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m runicbabble.service', description='Run the render service.')
+    parser.add_argument('--socket', default=cfg.render.service.socket('runic-render.sock'))
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    from runicbabble.formats import mdj_image
+
+    async def run():
+        # a separate port from the bot's `metrics.port`, both usually run on the same machine
+        port = cfg.render.service.metrics_port(None)
+        if port is not None:
+            await metrics.serve(cfg.metrics.host('127.0.0.1'), int(port))
+        pool = workers.pool()
+        # the workers don't share memory with this process, so each loads the fonts and atlases itself
+        sizes = tuple(cfg.render.warmup_sizes([32]))
+        await asyncio.gather(*(pool.run(mdj_image.warmup, sizes) for _ in range(pool.workers)))
+        serving = asyncio.ensure_future(RenderService(args.socket, pool).serve())
+        # shut down cleanly on SIGTERM as well, or the worker processes outlive the service
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, serving.cancel)
+        try:
+            await serving
+        except asyncio.CancelledError:
+            log.info('Render service stopped')
+        finally:
+            pool.shutdown()
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
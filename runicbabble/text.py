@@ -0,0 +1,145 @@
+import math
+import re
+
+# accented vowels are typed as the vowel followed by an apostrophe
+accents = {'a': 'á', 'e': 'é', 'i': 'í', 'o': 'ó', 'u': 'ú', 'y': 'ý', 'w': '\xb5'}
+_accent_map = {**{f"{k}'": v for k, v in accents.items()}, **{f"{k.upper()}'": v for k, v in accents.items()}}
+_accent_pattern = re.compile('|'.join(re.escape(k) for k in _accent_map))
+
+_separators = re.compile(r'[ \n]')
+
+wrap_modes = ('none', 'flow', 'force', 'optimal')
+
+
+def transliterate(text: str):
+    """
+    Replace the ASCII spellings of accented letters (like `a'`) with the characters the Madouji font uses for them,
+    in a single pass over the text.
+    """
+    return _accent_pattern.sub(lambda m: _accent_map[m.group()], text)
+
+
+def wrap(text: str, mode='none', line_length=8, advance=None):
+    """
+    Break text into lines. The result is produced as a stream of chunks whose concatenation is the wrapped text,
+    in time linear in the length of the input.
+
+    :param text: the text to wrap
+    :param mode: 'none' to keep the text as is, 'flow' to break lines at spaces once they reach `line_length`
+        characters, 'force' to break lines after exactly `line_length` characters, or 'optimal' to break lines at
+        spaces so that they are as even as possible while staying within `line_length`
+    :param line_length: the targeted amount of characters per line; in 'optimal' mode, the targeted line width in
+        the units of `advance`
+    :param advance: for 'optimal' mode, a function giving the width of a character (one unit per character if
+        omitted)
+    :return: an iterator over chunks of the wrapped text
+    """
+    if mode == 'none':
+        return iter((text,))
+    if mode == 'flow':
+        return _flow_wrap(text, line_length)
+    if mode == 'force':
+        return _force_wrap(text, max(line_length, 1))
+    if mode == 'optimal':
+        return _optimal_wrap(text, line_length, advance or (lambda c: 1))
+    raise ValueError(f'Unknown wrap mode "{mode}"')
+
+
+def wrap_text(text: str, mode='none', line_length=8, advance=None):
+    return ''.join(wrap(text, mode, line_length, advance))
+
+
+def lines(chunks):
+    """
+    Split a stream of text chunks (like the result of `wrap`) into lines, yielding every line as soon as it is
+    complete. Gives the same lines as `''.join(chunks).split('\\n')`.
+    """
+    current = []
+    for chunk in chunks:
+        parts = chunk.split('\n')
+        for part in parts[:-1]:
+            current.append(part)
+            yield ''.join(current)
+            current = []
+        current.append(parts[-1])
+    yield ''.join(current)
+
+
+def _force_wrap(text, line_length):
+    end = len(text)
+    cursor = 0
+    while cursor < end:
+        skip = cursor + line_length
+        find = text.find('\n', cursor, skip)
+        if find != -1:
+            skip = find + 1
+        yield text[cursor:skip]
+        cursor = skip
+        if find == -1 and cursor < end - 1:
+            yield '\n'
+
+
+def _flow_wrap(text, line_length):
+    linestart = 0
+    split1 = 0
+    for m in _separators.finditer(text):
+        cursor = m.start()
+        if cursor - linestart >= line_length:
+            yield '\n'
+            linestart = split1
+        yield text[split1:cursor + 1]
+        split1 = cursor + 1
+        if m.group() == '\n':
+            linestart = split1
+    if len(text) - linestart >= line_length:
+        yield '\n'
+    yield text[split1:]
+
+
+def _optimal_wrap(text, width, advance):
+    space = advance(' ')
+    widths = {}
+
+    def word_width(word):
+        return sum(widths[c] if c in widths else widths.setdefault(c, advance(c)) for c in word)
+
+    for number, paragraph in enumerate(text.split('\n')):
+        if number > 0:
+            yield '\n'
+        words = paragraph.split(' ')
+        lines = _minimum_raggedness([word_width(w) for w in words], space, width)
+        for start, end in lines:
+            yield ' '.join(words[start:end])
+            if end < len(words):
+                yield '\n'
+
+
+def _minimum_raggedness(word_widths, space, width):
+    """
+    Knuth-Plass style line breaking: choose the breaks that minimize the sum of squared leftover space over all lines
+    but the last one. Only breaks that keep a line within `width` are considered (unless a single word is wider than
+    that), so each word is compared with the few words that fit on a line with it, which is close to linear time.
+
+    :return: a list of (start, end) word index ranges, one per line
+    """
+    n = len(word_widths)
+    cost = [0] + [math.inf] * n
+    breaks = [0] * (n + 1)
+    for end in range(1, n + 1):
+        line = -space
+        for start in range(end - 1, -1, -1):
+            line += word_widths[start] + space
+            if line > width and start < end - 1:
+                break
+            slack = 0 if end == n or line > width else (width - line) ** 2
+            if cost[start] + slack < cost[end]:
+                cost[end] = cost[start] + slack
+                breaks[end] = start
+
+    lines = []
+    end = n
+    while end > 0:
+        lines.append((breaks[end], end))
+        end = breaks[end]
+    lines.reverse()
+    return lines
@@ -0,0 +1,181 @@
+import asyncio
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures.process import BrokenProcessPool
+
+from runicbabble import metrics
+from runicbabble.config import cfg
+
+log = logging.getLogger(__name__)
+
+
+class Saturated(Exception):
+    """
+    Raised when a job is submitted while all workers are busy and the queue is full.
+    """
+    pass
+
+
+class WorkerPool:
+    """
+    Runs blocking functions (like image rendering) outside of the event loop. At most `workers + queue_depth` jobs
+    are accepted at a time; anything beyond that is rejected with `Saturated` so callers can tell the user to retry
+    instead of piling up work. If jobs that timed out keep every worker busy, the workers are replaced.
+
+    :param start_method: how worker processes are started, see `multiprocessing.get_context`. Forking a process that
+        runs other threads can leave the child waiting forever on a lock one of them held, so the default is
+        'forkserver', or 'spawn' where that is not available.
+    :param preload: modules the worker processes import before they start, where the start method supports it
+    """
+
+    def __init__(self, workers, queue_depth, timeout=None, kind='process', start_method=None, preload=()):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.timeout = timeout
+        self.kind = kind
+        self.start_method = start_method
+        self.preload = preload
+        self.pending = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.restarts = 0
+        self._executor = None
+        self._lock = threading.Lock()
+        # the jobs that timed out while running and still keep their worker busy, and those of replaced executors
+        self._overdue = set()
+        self._written_off = set()
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = self._create_executor()
+        return self._executor
+
+    def _create_executor(self):
+        if self.kind == 'process':
+            try:
+                return concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=self._context())
+            except (OSError, NotImplementedError, ImportError):
+                log.warning('Process pools are not supported on this platform, falling back to threads')
+                self.kind = 'thread'
+        return concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='render')
+
+    def _context(self):
+        methods = multiprocessing.get_all_start_methods()
+        method = self.start_method or ('forkserver' if 'forkserver' in methods else 'spawn')
+        context = multiprocessing.get_context(method)
+        if method == 'forkserver' and self.preload:
+            context.set_forkserver_preload(list(self.preload))
+        return context
+
+    async def run(self, fn, *args):
+        """
+        Run `fn(*args)` in a worker and await its result.
+
+        :raises Saturated: if the pool is at capacity
+        :raises asyncio.TimeoutError: if the job took longer than the configured timeout
+        """
+        if self.pending >= self.workers + self.queue_depth:
+            self.rejected += 1
+            raise Saturated()
+
+        try:
+            executor = self.executor
+            future = executor.submit(fn, *args)
+        except BrokenProcessPool:
+            log.error('Worker pool is broken, recreating it')
+            self._executor = None
+            executor = self.executor
+            future = executor.submit(fn, *args)
+
+        # a job only frees its slot once the worker is actually done with it, even if the caller gave up waiting
+        with self._lock:
+            self.pending += 1
+        future.add_done_callback(self._release)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            # a job that already started can't be cancelled, it keeps its worker busy until it is done. Jobs of an
+            # executor that was already replaced fail on their own
+            if not future.cancel() and executor is self._executor:
+                with self._lock:
+                    # unless it finished in the meantime and was already released
+                    if not future.done():
+                        self._overdue.add(future)
+                    stuck = len(self._overdue) >= self.workers
+                if stuck:
+                    self._restart()
+            raise
+
+    def _release(self, future):
+        # called from the executor's threads
+        with self._lock:
+            if future in self._written_off:
+                self._written_off.discard(future)
+                return
+            self._overdue.discard(future)
+            self.pending -= 1
+
+    def _restart(self):
+        """
+        Replace the executor once all of its workers are busy with jobs that timed out. Worker processes are
+        terminated, which fails the jobs they still had queued. Threads can't be stopped, so they are left to finish,
+        but their jobs no longer count against the limit.
+        """
+        log.error(f'All {self.workers} workers are busy with jobs that timed out, replacing them')
+        with self._lock:
+            executor, self._executor = self._executor, None
+            self.pending -= len(self._overdue)
+            self._written_off.update(self._overdue)
+            self._overdue.clear()
+            self.restarts += 1
+        # ProcessPoolExecutor has no public way to stop a busy worker, and forgets its processes on shutdown
+        processes = list((getattr(executor, '_processes', None) or {}).values())
+        executor.shutdown(wait=False)
+        for process in processes:
+            process.terminate()
+
+    def shutdown(self, wait=True):
+        """
+        Stop the workers, dropping the jobs that haven't started yet.
+
+        :param wait: wait until the running jobs are done and the workers have exited
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
+
+    def stats(self):
+        return {
+            'kind': self.kind,
+            'workers': self.workers,
+            'queue_depth': self.queue_depth,
+            'pending': self.pending,
+            'rejected': self.rejected,
+            'timeouts': self.timeouts,
+            'restarts': self.restarts
+        }
+
+
+_pool = None
+
+
+def pool():
+    """
+    The shared render pool, configured by `render.workers`, `render.queue_depth`, `render.timeout`, `render.pool`
+    ('process' or 'thread') and `render.start_method`.
+    """
+    global _pool
+    if _pool is None:
+        _pool = WorkerPool(workers=int(cfg.render.workers(os.cpu_count() or 2)),
+                           queue_depth=int(cfg.render.queue_depth(16)),
+                           timeout=float(cfg.render.timeout(10)),
+                           kind=cfg.render.pool('process'),
+                           start_method=cfg.render.start_method(None),
+                           preload=('runicbabble.formats.mdj_image', 'runicbabble.formats.circle'))
+        metrics.register('workers', _pool.stats)
+    return _pool
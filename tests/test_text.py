@@ -0,0 +1,175 @@
+"""
+`runicbabble.text` replaced the transliteration and wrapping that mdj_emotes, mdj_image and the Madouji language
+each had their own copy of. These check that it gives the same results as those implementations, which are kept
+here as they were, and that the 'optimal' wrap mode finds the breaks a search of all of them would.
+"""
+import itertools
+import math
+import random
+
+import pytest
+
+from runicbabble import text
+
+
+def old_transliterate(message):
+    return message.replace('a\'', 'á').replace('A\'', 'á') \
+        .replace('e\'', 'é').replace('E\'', 'é') \
+        .replace('i\'', 'í').replace('I\'', 'í') \
+        .replace('o\'', 'ó').replace('O\'', 'ó') \
+        .replace('u\'', 'ú').replace('U\'', 'ú') \
+        .replace('y\'', 'ý').replace('Y\'', 'ý') \
+        .replace('w\'', '\xb5').replace('W\'', '\xb5')
+
+
+def old_text_wrap(message, line_length=8, force=False):
+    if force:
+        res = ''
+        cursor = 0
+        while cursor < len(message):
+            skip = cursor + line_length
+            find = message.find('\n', cursor, skip)
+            if find != -1:
+                skip = find + 1
+            res += message[cursor:skip]
+            cursor = skip
+            if find == -1 and cursor < len(message) - 1:
+                res += '\n'
+        message = res
+    else:
+        res = ''
+        linestart = 0
+        split1 = 0
+        cursor = 0
+        while cursor < len(message):
+            if message[cursor] == ' ' or message[cursor] == '\n':
+                if cursor - linestart >= line_length:
+                    res += '\n'
+                    linestart = split1
+                res += message[split1:cursor + 1]
+                split1 = cursor + 1
+                if message[cursor] == '\n':
+                    linestart = split1
+            cursor += 1
+        if cursor - linestart >= line_length:
+            res += '\n'
+        res += message[split1:cursor]
+        message = res
+
+    return message
+
+
+def random_messages(alphabet, count, seed):
+    rng = random.Random(seed)
+    for _ in range(count):
+        yield ''.join(rng.choice(alphabet) for _ in range(rng.randrange(0, 60)))
+
+
+# accents next to every vowel, in both cases, plus apostrophes and letters on their own
+TRANSLITERATION_ALPHABET = "aeiouywAEIOUYWpbtk''' "
+# short words and runs of separators, so lines break at, before and after the line length
+WRAP_ALPHABET = 'abcdefg      \n\n'
+
+
+def test_transliterate_matches_replace_chain():
+    for message in random_messages(TRANSLITERATION_ALPHABET, 5000, 1):
+        assert text.transliterate(message) == old_transliterate(message), message
+
+
+def test_transliterate_examples():
+    assert text.transliterate("a'e'i'o'u'y'w'") == 'áéíóúý\xb5'
+    assert text.transliterate("A'E'I'O'U'Y'W'") == 'áéíóúý\xb5'
+    assert text.transliterate("a''") == "á'"
+    assert text.transliterate("b'") == "b'"
+
+
+@pytest.mark.parametrize('mode', ['flow', 'force'])
+@pytest.mark.parametrize('line_length', [1, 2, 3, 8, 20])
+def test_wrap_matches_old_loops(mode, line_length):
+    for message in random_messages(WRAP_ALPHABET, 1000, line_length):
+        expected = old_text_wrap(message, line_length, force=(mode == 'force'))
+        assert text.wrap_text(message, mode, line_length) == expected, message
+
+
+def test_wrap_none_keeps_text():
+    for message in random_messages(WRAP_ALPHABET, 100, 0):
+        assert text.wrap_text(message, 'none', 8) == message
+
+
+def test_lines_matches_split():
+    for message in random_messages(WRAP_ALPHABET, 1000, 0):
+        for mode in ('flow', 'force'):
+            chunks = list(text.wrap(message, mode, 4))
+            assert list(text.lines(chunks)) == ''.join(chunks).split('\n')
+
+
+def advance(c):
+    # uneven glyph widths, like those of the font
+    return {' ': 3, 'a': 4, 'b': 7, 'c': 10, 'd': 5, 'e': 6, 'f': 12, 'g': 8}.get(c, 6)
+
+
+def brute_force_cost(word_widths, space, width):
+    # tries every way of breaking the words into lines
+    best = math.inf
+    for cuts in itertools.product((False, True), repeat=len(word_widths) - 1):
+        lines, start = [], 0
+        for i, cut in enumerate(cuts, 1):
+            if cut:
+                lines.append(word_widths[start:i])
+                start = i
+        lines.append(word_widths[start:])
+        cost = 0
+        for number, line in enumerate(lines):
+            length = sum(line) + space * (len(line) - 1)
+            if length > width and len(line) > 1:
+                break
+            if number < len(lines) - 1 and length <= width:
+                cost += (width - length) ** 2
+        else:
+            best = min(best, cost)
+    return best
+
+
+def line_cost(word_widths, space, width, lines):
+    cost = 0
+    for start, end in lines[:-1]:
+        length = sum(word_widths[start:end]) + space * (end - start - 1)
+        cost += 0 if length > width else (width - length) ** 2
+    return cost
+
+
+@pytest.mark.parametrize('width', [20, 40, 80])
+def test_optimal_lines_fit(width):
+    for message in random_messages(WRAP_ALPHABET, 1000, width):
+        wrapped = text.wrap_text(message, 'optimal', width, advance=advance)
+        # lines are only broken at spaces
+        assert wrapped.replace('\n', ' ') == message.replace('\n', ' '), message
+        for line in wrapped.split('\n'):
+            assert sum(advance(c) for c in line) <= width or ' ' not in line, (message, line)
+
+
+def test_minimum_raggedness_matches_brute_force():
+    rng = random.Random(0)
+    for _ in range(2000):
+        word_widths = [rng.randrange(0, 30) for _ in range(rng.randrange(1, 9))]
+        space, width = rng.randrange(0, 5), rng.randrange(5, 60)
+        lines = text._minimum_raggedness(word_widths, space, width)
+        assert lines[0][0] == 0 and lines[-1][1] == len(word_widths)
+        assert all(a[1] == b[0] for a, b in zip(lines, lines[1:]))
+        assert line_cost(word_widths, space, width, lines) == brute_force_cost(word_widths, space, width), \
+            (word_widths, space, width)
+
+
+def test_optimal_evens_out_lines():
+    # filling the first line as far as possible would leave a short second line
+    assert text.wrap_text('aaa bb cc ddddd', 'optimal', 6) == 'aaa\nbb cc\nddddd'
+    assert text.wrap_text('aaaaaaaaaa b', 'optimal', 4) == 'aaaaaaaaaa\nb'
+
+
+def test_optimal_empty_and_paragraphs():
+    assert text.wrap_text('', 'optimal', 10) == ''
+    assert text.wrap_text('\n\n', 'optimal', 10) == '\n\n'
+    message = 'aa bb cc dd\n\nee ff gg hh ii\n'
+    assert text.wrap_text(message, 'optimal', 5) == '\n'.join(text.wrap_text(paragraph, 'optimal', 5)
+                                                              for paragraph in message.split('\n'))
+    assert text.wrap_text(message, 'optimal', 5) == 'aa bb\ncc dd\n\nee ff\ngg hh\nii\n'